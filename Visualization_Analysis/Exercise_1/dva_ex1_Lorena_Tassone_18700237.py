@@ -1,89 +1,179 @@
+import os
+
+import numpy as np
 import pandas as pd
 from bokeh.layouts import row
 from bokeh.models import ColumnDataSource, HoverTool, Select, FactorRange
 from bokeh.plotting import figure, curdoc
 
+# path of the AZA data and of the columnar cache holding its cleaned frame
+CSV_PATH = 'AZA_MLE_Jul2018_utf8.csv'
+CACHE_PATH = 'AZA_MLE_Jul2018_utf8.cache.npz'
+
+# number of species with the highest 'mle' that are shown per taxon class
+TOP_N = 10
+
 # definition of the callback function that changes the source data and y range
 def callback(attr, old, new):
-    if dropdown.value == 'Mammalia':
-        source.data = dict(source_mammalia.data)
-        p.y_range.factors = source.data['species'].to_list()
-    elif dropdown.value == 'Aves':
-        source.data = dict(source_aves.data)
-        p.y_range.factors = source.data['species'].to_list()
+    payload = top_n_index[new]
+    change = diff_payload(source.data, payload)
+
+    # only the changed rows of each column are sent to the browser, a shrinking payload replaces the data (the columns
+    # are copied because patches modify the data of the source in place)
+    if change is None:
+        source.data = {col: values.copy() for col, values in payload.items()}
     else:
-        source.data = dict(source_reptilia.data)
-        p.y_range.factors = source.data['species'].to_list()
+        patches, tail = change
+        if patches:
+            source.patch(patches)
+        if tail:
+            source.stream(tail)
+
+    # the species list of the payload is the cached factor list of the taxon class, so nothing is rebuilt or sent when
+    # the factors did not change
+    if list(p.y_range.factors) != payload['species']:
+        p.y_range.factors = payload['species']
+
+
+def diff_payload(current, target):
+    """
+    Computes the minimal change that turns the current data of a ColumnDataSource into the target payload.
+
+    :param current: The data dict of the ColumnDataSource
+    :param target: The payload of a taxon class as built by build_top_n_index
+    :return: A tuple of a dict of patches with one slice over the changed rows per changed column and a dict of rows
+        to stream, or None if the target has fewer rows than the current data
+    """
+    n_current = len(current['species'])
+    if len(target['species']) < n_current:
+        return None
+
+    patches = {}
+    tail = {}
+    for col, values in target.items():
+        changed = np.flatnonzero(np.asarray(current[col]) != np.asarray(values[:n_current]))
+        if len(changed) > 0:
+            start, stop = int(changed[0]), int(changed[-1]) + 1
+            patches[col] = [(slice(start, stop), values[start:stop])]
+        if len(values) > n_current:
+            tail[col] = values[n_current:]
+
+    return patches, tail
+
+
+def read_aza_csv(csv_path) -> pd.DataFrame:
+    """
+    Parses the AZA .csv file into a cleaned, renamed and typed data frame.
+
+    :param csv_path: Path of the AZA .csv file
+    :return: A data frame with the columns species, taxon_class, mle, ci_lower, ci_upper, male_deficient and
+        female_deficient
+    """
+    # reading data from .csv file
+    frame = pd.read_csv(csv_path, encoding='utf-8')
+
+    # constructing list of indizes to remove unnecessary columns
+    cols = [1, 3]
+    cols.extend([i for i in range(7, 15)])
+    frame.drop(frame.columns[cols], axis=1, inplace=True)
+
+    # renaming the columns of the data frame
+    frame.rename(columns={'Species Common Name': 'species', 'TaxonClass': 'taxon_class',
+                          'Overall CI - lower': 'ci_lower', 'Overall CI - upper': 'ci_upper', 'Overall MLE': 'mle',
+                          'Male Data Deficient': 'male_deficient', 'Female Data Deficient': 'female_deficient'},
+                 inplace=True)
+
+    # renaming the species 'Penguin, Northern & Southern Rockhopper (combined)' of the aves
+    frame['species'] = frame['species'].replace(
+        {'Penguin, Northern & Southern Rockhopper (combined)': 'Penguin, Rockhopper'})
+
+    # storing the taxon classes as categories, the life expectancies as float32 and the data deficient flags as booleans
+    frame['taxon_class'] = frame['taxon_class'].astype('category')
+    for col in ['mle', 'ci_lower', 'ci_upper']:
+        frame[col] = frame[col].astype(np.float32)
+    for col in ['male_deficient', 'female_deficient']:
+        frame[col] = frame[col].eq('yes')
+
+    return frame[['species', 'taxon_class', 'mle', 'ci_lower', 'ci_upper', 'male_deficient', 'female_deficient']]
+
+
+def load_aza_frame(csv_path=CSV_PATH, cache_path=CACHE_PATH) -> pd.DataFrame:
+    """
+    Loads the cleaned AZA data frame from its columnar cache file, which is rewritten whenever the modification time or
+    the size of the .csv file changed.
+
+    :param csv_path: Path of the AZA .csv file
+    :param cache_path: Path of the .npz cache file
+    :return: The data frame returned by read_aza_csv
+    """
+    stat = os.stat(csv_path)
+    source_stat = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            if np.array_equal(cache['source_stat'], source_stat):
+                frame = pd.DataFrame({col: cache[col] for col in ['species', 'mle', 'ci_lower', 'ci_upper',
+                                                                  'male_deficient', 'female_deficient']})
+                frame.insert(1, 'taxon_class', pd.Categorical.from_codes(cache['taxon_class_codes'],
+                                                                         categories=cache['taxon_class_categories']))
+                return frame
+    except (OSError, KeyError, ValueError):
+        # a missing, outdated or unreadable cache is simply rebuilt
+        pass
+
+    frame = read_aza_csv(csv_path)
+
+    # writing to a temporary file first so that concurrent sessions never read a partially written cache
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as fh:
+        np.savez(fh, source_stat=source_stat,
+                 species=frame['species'].to_numpy(dtype=str),
+                 taxon_class_codes=frame['taxon_class'].cat.codes.to_numpy(),
+                 taxon_class_categories=frame['taxon_class'].cat.categories.to_numpy(dtype=str),
+                 **{col: frame[col].to_numpy() for col in ['mle', 'ci_lower', 'ci_upper', 'male_deficient',
+                                                           'female_deficient']})
+    os.replace(tmp_path, cache_path)
+
+    return frame
+
+
+def build_top_n_index(frame, n=TOP_N) -> dict:
+    """
+    Builds the top-n species of every taxon class in a single grouped pass over the data frame.
+
+    :param frame: The renamed AZA data frame
+    :param n: Number of species with the highest 'mle' that are kept per taxon class
+    :return: A dict mapping each taxon class to a dict to pass into the ColumnDataSource, sorted by 'mle' ascending
+    """
+    # removing the outliers and the data that has no 'mle' value
+    valid = frame.loc[~frame['male_deficient'] & ~frame['female_deficient'] & frame['mle'].notna()]
+
+    # after one stable descending sort the first n rows of every group are the n species with the highest 'mle'
+    index = {}
+    ranked = valid.sort_values('mle', ascending=False, kind='stable')
+    for taxon_class, group in ranked.groupby('taxon_class', observed=True):
+        top = group.head(n).iloc[::-1]
+        index[taxon_class] = dict(
+            species=top['species'].to_list(),
+            mle=top['mle'].to_numpy(),
+            ci_lower=top['ci_lower'].to_numpy(),
+            ci_upper=top['ci_upper'].to_numpy())
+
+    return index
 
-# reading data from .csv file
-df = pd.read_csv('AZA_MLE_Jul2018_utf8.csv', encoding='utf-8')
 
-# constructing list of indizes to remove unnecessary columns
-cols = [1, 3]
-cols.extend([i for i in range(7, 15)])
-df.drop(df.columns[cols], axis=1, inplace=True)
+### task 1
 
+# reading the cleaned data frame, the .csv file is only parsed again when it changed since the cache was written
+df = load_aza_frame()
 
-### task 1
+# precomputing the ColumnDataSource payload of the top species for every taxon class in the data
+top_n_index = build_top_n_index(df)
+taxon_classes = list(top_n_index)
+initial_taxon_class = 'Mammalia' if 'Mammalia' in top_n_index else taxon_classes[0]
 
-# renaming the columns of the data frame
-df.rename(columns={'Species Common Name': 'species', 'TaxonClass': 'taxon_class', 'Overall CI - lower': 'ci_lower',
-                    'Overall CI - upper': 'ci_upper', 'Overall MLE': 'mle', 'Male Data Deficient': 'male_deficient',
-                    'Female Data Deficient': 'female_deficient'}, inplace=True)
-
-# constructing three independent dataframes based taxon classes 'Mammalia', 'Aves', 'Reptilia' and removing the outliers
-df_mammalia = df.loc[(df['male_deficient'] != 'yes') & (df['female_deficient'] != 'yes') & (df['taxon_class'] == 'Mammalia')]
-df_aves = df.loc[(df['male_deficient'] != 'yes') & (df['female_deficient'] != 'yes') & (df['taxon_class'] == 'Aves')]
-df_reptilia = df.loc[(df['male_deficient'] != 'yes') & (df['female_deficient'] != 'yes') & (df['taxon_class'] == 'Reptilia')]
-
-# removing data that has no 'mle' value
-df_mammalia = df_mammalia.drop(df_mammalia[df_mammalia['mle'].isnull()].index)
-df_aves = df_aves.drop(df_aves[df_aves['mle'].isnull()].index)
-df_reptilia = df_reptilia.drop(df_reptilia[df_reptilia['mle'].isnull()].index)
-
-# sorting the dataframes by 'mle' in descending order and reseting the index
-df_mammalia = df_mammalia.sort_values('mle', ascending=False, na_position='last', ignore_index=True)
-df_aves = df_aves.sort_values('mle', ascending=False, na_position='last', ignore_index=True)
-df_reptilia = df_reptilia.sort_values('mle', ascending=False, na_position='last', ignore_index=True)
-
-# reducing each dataframe to contain only the 10 species with the highest 'mle'
-df_mammalia = df_mammalia.nlargest(10, ['mle'])
-df_aves = df_aves.nlargest(10, ['mle'])
-df_reptilia = df_reptilia.nlargest(10, ['mle'])
-
-# sorting the dataframes in ascending order and reseting the index
-df_mammalia = df_mammalia.sort_values('mle', ascending=True, ignore_index=True)
-df_aves = df_aves.sort_values('mle', ascending=True, ignore_index=True)
-df_reptilia = df_reptilia.sort_values('mle', ascending=True, ignore_index=True)
-
-# renaming the species'Penguin, Northern & Southern Rockhopper (combined)' in the aves dataframe
-df_aves['species'] = df_aves['species'].replace({'Penguin, Northern & Southern Rockhopper (combined)': 'Penguin, Rockhopper'})
-
-# constructing a ColumDataSource for each of the dataframes
-source_mammalia = ColumnDataSource(data=dict(
-    species=df_mammalia['species'],
-    mle=df_mammalia['mle'],
-    ci_lower=df_mammalia['ci_lower'],
-    ci_upper=df_mammalia['ci_upper']))
-
-source_aves = ColumnDataSource(data=dict(
-    species=df_aves['species'],
-    mle=df_aves['mle'],
-    ci_lower=df_aves['ci_lower'],
-    ci_upper=df_aves['ci_upper']))
-
-source_reptilia = ColumnDataSource(data=dict(
-    species=df_reptilia['species'],
-    mle=df_reptilia['mle'],
-    ci_lower=df_reptilia['ci_lower'],
-    ci_upper=df_reptilia['ci_upper']))
-
-# constructing a fourth ColumDataSource that is used as input for the plot with initial value 'Mammalia'
-source = ColumnDataSource(data=dict(
-    species=df_mammalia['species'],
-    mle=df_mammalia['mle'],
-    ci_lower=df_mammalia['ci_lower'],
-    ci_upper=df_mammalia['ci_upper']))
+# constructing the ColumDataSource that is used as input for the plot with initial value 'Mammalia'
+source = ColumnDataSource(data={col: values.copy() for col, values in top_n_index[initial_taxon_class].items()})
 
 
 ### task 2:
@@ -91,8 +181,8 @@ source = ColumnDataSource(data=dict(
 hover = HoverTool(tooltips=[('low', '@ci_lower'),('high', '@ci_upper')])
 
 # constructing a figure with axis label, hovertools and disabled toolbar
-p = figure(x_range=(0, 51), y_range=FactorRange(factors=source.data['species'].to_list()), plot_height=500, plot_width=800,
-           title='Medium Life Expectancy of Animals in Zoos',)
+p = figure(x_range=(0, 51), y_range=FactorRange(factors=top_n_index[initial_taxon_class]['species']), plot_height=500,
+           plot_width=800, title='Medium Life Expectancy of Animals in Zoos',)
 p.yaxis.axis_label = 'Species'
 p.xaxis.axis_label = 'Medium Life Expectancy [Years]'
 p.toolbar.logo = None
@@ -103,8 +193,9 @@ p.sizing_mode = "stretch_both"
 # adding the horizontal bar chart to the figure
 p.hbar(y='species', left='ci_lower', right='ci_upper', height=0.4, source=source)
 
-# creating a Select dropdown tool and configuring its 'on_change' callback (default visualization is 'Mammalia')
-dropdown = Select(value='Mammalia', options=['Mammalia', 'Aves', 'Reptilia'], title="Select Taxon Class")
+# creating a Select dropdown tool with every taxon class and configuring its 'on_change' callback (default
+# visualization is 'Mammalia')
+dropdown = Select(value=initial_taxon_class, options=taxon_classes, title="Select Taxon Class")
 dropdown.on_change('value', callback)
 
 # visualization
@@ -0,0 +1,224 @@
+import argparse
+import glob
+import time
+
+import numpy as np
+
+from image_features import (load_pixels, numpy_histograms, histograms_from_pixels, normalize_histograms, pack_histograms,
+                            storage_report)
+from embedding import (PCA_MODES, SIMILARITY_METRICS, SimilarityIndex, brute_force_neighbors, compute_embeddings,
+                       format_timings)
+
+# Bin counts of the app
+N_BINS_COLOR = 16
+N_BINS_CHANNEL = 50
+
+
+def sample_pixel_arrays(image_glob, n_images, seed=0) -> list:
+    """
+    Loads the pixels of the first images matching the glob, or creates random images if there are none.
+
+    :param image_glob: Glob pattern of the images
+    :param n_images: Maximal number of images
+    :param seed: Seed of the random images
+    :return: A list of N_Pixel x 3 uint8 arrays
+    """
+    paths = sorted(glob.glob(image_glob))[:n_images]
+    if paths:
+        return [load_pixels(path) for path in paths]
+
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (640 * 480, 3), dtype=np.uint8) for _ in range(n_images)]
+
+
+def check_kernel(pixel_arrays, n_bins_color=N_BINS_COLOR, n_bins_channel=N_BINS_CHANNEL) -> bool:
+    """
+    Checks that the fused kernel gives exactly the histograms of numpy_histograms, for the given images and for an
+    image containing every uint8 value in every channel.
+
+    :param pixel_arrays: A list of N_Pixel x 3 uint8 arrays
+    :param n_bins_color: Number of bins per color for the 3D histogram
+    :param n_bins_channel: Number of bins per channel for the channel histograms
+    :return: True if all histograms are equal
+    """
+    every_value = np.stack(np.meshgrid(np.arange(256), np.arange(256), np.arange(256)), axis=-1)
+    pixel_arrays = [every_value.reshape(-1, 3).astype(np.uint8), *pixel_arrays]
+
+    color, channel = histograms_from_pixels(pixel_arrays, n_bins_color, n_bins_channel)
+    for idx, pixels in enumerate(pixel_arrays):
+        ref_color, ref_channel = numpy_histograms(pixels, n_bins_color, n_bins_channel)
+        if not (np.array_equal(color[idx], ref_color) and np.array_equal(channel[idx], ref_channel)):
+            return False
+    return True
+
+
+def benchmark_kernel(args):
+    pixel_arrays = sample_pixel_arrays(args.images, args.n_images)
+    for n_bins_color, n_bins_channel in [(N_BINS_COLOR, N_BINS_CHANNEL), (8, 256), (32, 17)]:
+        ok = check_kernel(pixel_arrays[:4], n_bins_color, n_bins_channel)
+        print('kernel == numpy for {} color bins and {} channel bins: {}'.format(n_bins_color, n_bins_channel, ok))
+
+    start = time.perf_counter()
+    for pixels in pixel_arrays:
+        numpy_histograms(pixels, N_BINS_COLOR, N_BINS_CHANNEL)
+    t_numpy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for pixels in pixel_arrays:
+        histograms_from_pixels([pixels], N_BINS_COLOR, N_BINS_CHANNEL)
+    t_kernel = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for batch_start in range(0, len(pixel_arrays), args.batch_size):
+        histograms_from_pixels(pixel_arrays[batch_start:batch_start + args.batch_size], N_BINS_COLOR, N_BINS_CHANNEL)
+    t_batched = time.perf_counter() - start
+
+    print('{} images, numpy: {:.3f}s, kernel: {:.3f}s ({:.1f}x), kernel with batches of {}: {:.3f}s ({:.1f}x)'.format(
+        len(pixel_arrays), t_numpy, t_kernel, t_numpy / t_kernel, args.batch_size, t_batched, t_numpy / t_batched))
+
+
+def synthetic_color_histograms(n_images, n_bins_color=N_BINS_COLOR, n_colors=40, seed=0) -> np.ndarray:
+    """
+    Creates color histograms that resemble the ones of natural photos: every image only uses a few dozen of the bins.
+
+    :param n_images: Number of images
+    :param n_bins_color: Number of bins per color
+    :param n_colors: Number of occupied bins per image
+    :param seed: Seed of the random histograms
+    :return: An n_images x n_bins_color^3 float64 array
+    """
+    rng = np.random.default_rng(seed)
+    histograms = np.zeros((n_images, n_bins_color**3))
+    # every image picks its colors around one of a few palettes, so that the embeddings have some structure
+    palettes = rng.integers(0, n_bins_color**3, (8, n_colors))
+    for idx in range(n_images):
+        bins = palettes[rng.integers(0, len(palettes))] + rng.integers(-2, 3, n_colors)
+        np.add.at(histograms[idx], np.clip(bins, 0, n_bins_color**3 - 1), rng.integers(100, 5000, n_colors))
+    return histograms
+
+
+def benchmark_dimred(args):
+    histograms = synthetic_color_histograms(args.n_images)
+    for mode in args.modes:
+        for dtype in (np.float64, np.float32):
+            _, timings = compute_embeddings(histograms, pca_mode=mode, dtype=dtype)
+            print('{} images, {} PCA, {}: {}'.format(args.n_images, mode, np.dtype(dtype).name,
+                                                     format_timings(timings)))
+        _, timings = compute_embeddings(pack_histograms(histograms, 'sparse'), pca_mode=mode)
+        print('{} images, {} PCA, sparse float32: {}'.format(args.n_images, mode, format_timings(timings)))
+        # fewer images than principal components for t-SNE, like a folder with a dozen photos
+        _, timings = compute_embeddings(pack_histograms(histograms[:args.n_small_images], 'sparse'), pca_mode=mode)
+        print('{} images, {} PCA, sparse float32: {}'.format(args.n_small_images, mode, format_timings(timings)))
+
+
+def benchmark_decode(args):
+    paths = sorted(glob.glob(args.images))[:args.n_images]
+    if not paths:
+        print('no images match {}'.format(args.images))
+        return
+
+    def decode_all(**decoding):
+        start = time.perf_counter()
+        pixel_arrays = [load_pixels(path, **decoding) for path in paths]
+        duration = time.perf_counter() - start
+        color, channel = histograms_from_pixels(pixel_arrays, N_BINS_COLOR, N_BINS_CHANNEL)
+        # the reduced images have fewer pixels, so the histograms are compared as distributions
+        return duration, color / color.sum(axis=1, keepdims=True), channel / channel.sum(axis=2, keepdims=True)
+
+    t_full, color_full, channel_full = decode_all()
+    print('{} images, full resolution decode: {:.2f}s'.format(len(paths), t_full))
+    decodings = [dict(draft_scale=scale) for scale in (2, 4, 8)]
+    decodings += [dict(max_pixels=max_pixels) for max_pixels in (1_000_000, 250_000, 60_000)]
+    for decoding in decodings:
+        duration, color, channel = decode_all(**decoding)
+        # L1 distance between the normalized histograms, 0 means identical and 2 means disjoint
+        color_error = np.abs(color - color_full).sum(axis=1)
+        channel_error = np.abs(channel - channel_full).sum(axis=2).max(axis=1)
+        print('{:>20}: {:.2f}s ({:.1f}x), color histogram L1 error mean {:.4f} max {:.4f}, channel histogram L1 '
+              'error mean {:.4f} max {:.4f}'.format(
+                  ', '.join('{}={}'.format(*item) for item in decoding.items()), duration, t_full / duration,
+                  color_error.mean(), color_error.max(), channel_error.mean(), channel_error.max()))
+
+
+def benchmark_neighbors(args):
+    histograms = normalize_histograms(pack_histograms(synthetic_color_histograms(args.n_images), 'sparse'), 'l1')
+    queries = np.random.default_rng(1).choice(histograms.shape[0], args.n_queries, replace=False)
+
+    for metric in args.metrics:
+        start = time.perf_counter()
+        index = SimilarityIndex(histograms, metric)
+        t_build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact = [brute_force_neighbors(histograms, idx, args.k, metric) for idx in queries]
+        t_brute = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        found = [index.query(idx, args.k) for idx in queries]
+        t_index = (time.perf_counter() - start) / len(queries)
+
+        # neighbours at the same distance as the k-th exact one are as good as the exact ones, up to the float32
+        # rounding of the histograms
+        recall = np.mean([np.count_nonzero(distances <= exact_distances[-1] * (1 + 1e-6)) / args.k
+                          for (_, exact_distances), (_, distances) in zip(exact, found)])
+        # share of the histogram entries a query visits, a brute force search visits all of them
+        list_lengths = np.diff(index.postings.indptr)
+        visited = np.mean([list_lengths[histograms[idx].indices].sum() for idx in queries]) / histograms.nnz
+        print('{} images, {}: index build {:.2f}s, query {:.2f}ms, brute force {:.2f}ms ({:.0f}x), recall@{} {:.3f}, '
+              '{:.1f}% of the entries visited'.format(args.n_images, metric, t_build, 1000 * t_index, 1000 * t_brute,
+                                                      t_brute / t_index, args.k, recall, 100 * visited))
+
+
+def benchmark_memory(args):
+    paths = sorted(glob.glob(args.images))[:args.n_images]
+    if paths:
+        histograms = np.concatenate([histograms_from_pixels([load_pixels(path)], N_BINS_COLOR, N_BINS_CHANNEL)[0]
+                                     for path in paths])
+    else:
+        histograms = synthetic_color_histograms(args.n_images)
+    print('color histograms of {} images, {:.1f}% of the bins occupied'.format(
+        histograms.shape[0], 100 * np.count_nonzero(histograms) / histograms.size))
+    print(storage_report(histograms))
+
+
+if __name__ == '__main__':
+    # python benchmark.py kernel --images "static/*.jpg"
+    # python benchmark.py dimred --n-images 10000 --modes randomized incremental
+    # python benchmark.py memory --images "static/*.jpg"
+    # python benchmark.py decode --images "static/*.jpg"
+    # python benchmark.py neighbors --n-images 100000
+    parser = argparse.ArgumentParser(description='Correctness checks and benchmarks of the image explorer')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    kernel_parser = subparsers.add_parser('kernel', help='check and time the fused histogram kernel')
+    kernel_parser.add_argument('--images', default='static/*.jpg', help='glob of the images, random if none match')
+    kernel_parser.add_argument('--n-images', type=int, default=32)
+    kernel_parser.add_argument('--batch-size', type=int, default=8)
+    kernel_parser.set_defaults(run=benchmark_kernel)
+
+    dimred_parser = subparsers.add_parser('dimred', help='time the dimensionality reduction engines')
+    dimred_parser.add_argument('--n-images', type=int, default=2000)
+    dimred_parser.add_argument('--n-small-images', type=int, default=12,
+                               help='number of images of the small sparse case')
+    dimred_parser.add_argument('--modes', nargs='+', choices=PCA_MODES, default=list(PCA_MODES))
+    dimred_parser.set_defaults(run=benchmark_dimred)
+
+    decode_parser = subparsers.add_parser('decode', help='compare reduced resolution decoding with full resolution')
+    decode_parser.add_argument('--images', default='static/*.jpg', help='glob of the images')
+    decode_parser.add_argument('--n-images', type=int, default=100)
+    decode_parser.set_defaults(run=benchmark_decode)
+
+    neighbors_parser = subparsers.add_parser('neighbors', help='compare the similarity index with a brute force search')
+    neighbors_parser.add_argument('--n-images', type=int, default=20000)
+    neighbors_parser.add_argument('--n-queries', type=int, default=50)
+    neighbors_parser.add_argument('--k', type=int, default=8)
+    neighbors_parser.add_argument('--metrics', nargs='+', choices=SIMILARITY_METRICS, default=list(SIMILARITY_METRICS))
+    neighbors_parser.set_defaults(run=benchmark_neighbors)
+
+    memory_parser = subparsers.add_parser('memory', help='compare the memory of the color histogram storage layouts')
+    memory_parser.add_argument('--images', default='static/*.jpg', help='glob of the images, synthetic if none match')
+    memory_parser.add_argument('--n-images', type=int, default=1000)
+    memory_parser.set_defaults(run=benchmark_memory)
+
+    args = parser.parse_args()
+    args.run(args)
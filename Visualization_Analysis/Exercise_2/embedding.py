@@ -0,0 +1,228 @@
+import time
+
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.manifold import TSNE
+
+# Selectable PCA engines: 'full' computes the exact SVD, 'truncated' only the two leading components with ARPACK,
+# 'randomized' approximates them with a randomized SVD and 'incremental' fits them batch by batch, so that only one
+# batch has to be held as a dense array at a time. Sparse features are never densified: 'full' then uses the exact
+# eigendecomposition of the D x D covariance matrix if there are at least as many samples as features, and ARPACK with
+# implicit centering otherwise, where the dense covariance would cost more than the dense SVD. 'randomized', which
+# sklearn does not offer for sparse input, always falls back to ARPACK.
+PCA_MODES = ('full', 'truncated', 'randomized', 'incremental')
+
+
+def reduce_pca(features, mode='randomized', n_components=2, batch_size=None, random_state=0) -> np.ndarray:
+    """
+    Projects the features onto their leading principal components.
+
+    :param features: An N x D feature array or sparse matrix
+    :param mode: One of PCA_MODES
+    :param n_components: Number of components
+    :param batch_size: Number of rows per batch of the incremental mode, if None 5 * D rows are used
+    :param random_state: Seed of the randomized mode
+    :return: An N x n_components array
+    """
+    if sparse.issparse(features) and mode in ('full', 'randomized'):
+        n_samples, n_features = features.shape
+        mode = 'covariance' if mode == 'full' and n_samples >= n_features else 'truncated'
+
+    if mode == 'full':
+        pca = PCA(n_components=n_components, svd_solver='full')
+    elif mode == 'covariance':
+        pca = PCA(n_components=n_components, svd_solver='covariance_eigh')
+    elif mode == 'truncated':
+        pca = PCA(n_components=n_components, svd_solver='arpack', random_state=random_state)
+    elif mode == 'randomized':
+        pca = PCA(n_components=n_components, svd_solver='randomized', random_state=random_state)
+    elif mode == 'incremental':
+        pca = IncrementalPCA(n_components=n_components, batch_size=batch_size)
+    else:
+        raise ValueError('unknown PCA mode {!r}, expected one of {}'.format(mode, PCA_MODES))
+
+    return pca.fit_transform(features)
+
+
+def reduce_tsne(features, init, perplexity=30.0, angle=0.5, random_state=0) -> np.ndarray:
+    """
+    Computes a 2D t-SNE embedding with the Barnes-Hut approximation, starting from the given initial embedding.
+
+    :param features: An N x D feature matrix
+    :param init: An N x 2 initial embedding, e.g. the PCA result
+    :param perplexity: Perplexity of t-SNE, it is lowered for very small N where it has to stay below N
+    :param angle: Trade-off between speed and accuracy of the Barnes-Hut approximation
+    :param random_state: Seed of t-SNE
+    :return: An N x 2 array
+    """
+    # Scale the initialization like sklearn does for init='pca', a wide initial embedding slows down the optimization
+    init = np.asarray(init, dtype=np.float32)
+    init = init / np.std(init[:, 0]) * 1e-4 if np.std(init[:, 0]) > 0 else init
+
+    tsne = TSNE(n_components=2, method='barnes_hut', angle=angle, init=init, learning_rate='auto',
+                perplexity=min(perplexity, (features.shape[0] - 1) / 3), random_state=random_state)
+    return tsne.fit_transform(features)
+
+
+def compute_embeddings(features, pca_mode='randomized', dtype=np.float32, tsne_input_dims=50, batch_size=None,
+                       random_state=0) -> tuple:
+    """
+    Computes the 2D PCA and t-SNE embeddings of the features and times every step. t-SNE starts from the PCA result and
+    runs on the features reduced to tsne_input_dims principal components, which is what makes its neighbour search
+    affordable for 4096-dimensional histograms. Both come from a single PCA, the 2D embedding is its first two
+    components.
+
+    :param features: An N x D feature array or sparse matrix
+    :param pca_mode: One of PCA_MODES
+    :param dtype: Data type the features are converted to before the reductions
+    :param tsne_input_dims: Number of principal components t-SNE runs on, None runs it on the features themselves
+    :param batch_size: Number of rows per batch of the incremental PCA mode
+    :param random_state: Seed of the randomized steps
+    :return: A tuple of a dict with the 'pca' and 'tsne' N x 2 embeddings and a dict with the duration of every step in
+        seconds
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    features = features.astype(dtype, copy=False)
+    timings['convert'] = time.perf_counter() - start
+
+    # the components are sorted by their variance, so the leading two of the t-SNE input are the 2D embedding
+    reduce_input = tsne_input_dims is not None and tsne_input_dims < min(features.shape)
+    start = time.perf_counter()
+    coords = reduce_pca(features, pca_mode, n_components=max(tsne_input_dims, 2) if reduce_input else 2,
+                        batch_size=batch_size, random_state=random_state)
+    coords_pca = np.ascontiguousarray(coords[:, :2])
+    timings['pca'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    coords_tsne = reduce_tsne(coords if reduce_input else features, coords_pca, random_state=random_state)
+    timings['tsne'] = time.perf_counter() - start
+
+    return dict(pca=coords_pca, tsne=coords_tsne), timings
+
+
+def format_timings(timings) -> str:
+    """
+    Formats the timings of compute_embeddings as a one line report.
+
+    :param timings: A dict with the duration of every step in seconds
+    :return: The report
+    """
+    steps = ', '.join('{}: {:.2f}s'.format(step, duration) for step, duration in timings.items())
+    return 'dimensionality reduction took {:.2f}s ({})'.format(sum(timings.values()), steps)
+
+
+# Histogram distances of the similarity search
+SIMILARITY_METRICS = ('intersection', 'chi2')
+
+
+def histogram_distances(histograms, query, metric='intersection') -> np.ndarray:
+    """
+    Distances between L1 normalized histograms. Sparse histograms are compared on their occupied bins only.
+
+    :param histograms: An N x B array or sparse CSR matrix of L1 normalized histograms
+    :param query: A B array, the L1 normalized histogram to compare with
+    :param metric: 'intersection' for 1 minus the histogram intersection or 'chi2' for the chi-square distance, both
+        are 0 for identical and 1 for disjoint histograms
+    :return: An N array of distances
+    """
+    if metric not in SIMILARITY_METRICS:
+        raise ValueError('unknown metric {!r}, expected one of {}'.format(metric, SIMILARITY_METRICS))
+
+    if sparse.issparse(histograms):
+        def row_sums(values):
+            return sparse.csr_matrix((values, histograms.indices, histograms.indptr), shape=histograms.shape).sum(
+                axis=1).A1
+
+        p, q = histograms.data, query[histograms.indices]
+        if metric == 'intersection':
+            return 1.0 - row_sums(np.minimum(p, q))
+        # the bins that are empty in a histogram contribute their query value to the chi-square sum
+        return 0.5 * (query.sum() - row_sums(q) + row_sums((p - q) ** 2 / (p + q)))
+
+    if metric == 'intersection':
+        return 1.0 - np.minimum(histograms, query).sum(axis=1)
+    total = histograms + query
+    diff = (histograms - query) ** 2
+    return 0.5 * np.divide(diff, total, out=np.zeros_like(diff), where=total > 0).sum(axis=1)
+
+
+def brute_force_neighbors(histograms, idx, k=8, metric='intersection', chunk_size=4096) -> tuple:
+    """
+    Exact nearest neighbours of an image by comparing its histogram with every other one.
+
+    :param histograms: An N x B array or sparse CSR matrix of L1 normalized histograms
+    :param idx: Index of the query image
+    :param k: Number of neighbours
+    :param metric: One of SIMILARITY_METRICS
+    :param chunk_size: Number of histograms that are compared at a time
+    :return: A tuple of the indices and the distances of the k nearest other images, closest first
+    """
+    query = _query_row(histograms, idx)
+    distances = np.concatenate([histogram_distances(histograms[start:start + chunk_size], query, metric)
+                                for start in range(0, histograms.shape[0], chunk_size)])
+    distances[idx] = np.inf
+    nearest = np.argsort(distances, kind='stable')[:k]
+    return nearest, distances[nearest]
+
+
+def _query_row(histograms, idx) -> np.ndarray:
+    # Dense copy of one histogram of an array or sparse matrix
+    row = histograms[idx]
+    return row.toarray()[0] if sparse.issparse(row) else np.asarray(row)
+
+
+class SimilarityIndex:
+    """
+    Exact nearest neighbour index over color histograms, an inverted file that lists for every bin the images that
+    occupy it. Both SIMILARITY_METRICS only depend on the bins two L1 normalized histograms share: the intersection
+    distance is 1 - sum(min(p, q)) and the chi-square distance 1 - 2 * sum(p * q / (p + q)) over the shared bins. A query
+    therefore only visits the lists of its own bins. These never hold more entries than a scan over all histograms,
+    since every entry belongs to a bin of the query, and for images with distinct colors only a small part of them.
+
+    :param histograms: An N x B array or sparse CSR matrix of L1 normalized histograms
+    :param metric: One of SIMILARITY_METRICS
+    :param postings: The inverted file of the histograms as stored by an earlier index, see postings, if None it is
+        built
+    """
+
+    def __init__(self, histograms, metric='intersection', postings=None):
+        if metric not in SIMILARITY_METRICS:
+            raise ValueError('unknown metric {!r}, expected one of {}'.format(metric, SIMILARITY_METRICS))
+        self.histograms = histograms
+        self.metric = metric
+        # A B x N CSR matrix, row b lists the images that occupy bin b and their share of it. It only depends on the
+        # histograms, so it can be stored with them and reused for both metrics.
+        self.postings = postings if postings is not None else sparse.csr_matrix(histograms, dtype=np.float32).T.tocsr()
+
+    def query(self, idx, k=8) -> tuple:
+        """
+        Nearest neighbours of an image.
+
+        :param idx: Index of the query image
+        :param k: Number of neighbours
+        :return: A tuple of the indices and the distances of the k nearest other images, closest first
+        """
+        n_images = self.histograms.shape[0]
+        k = min(k, n_images - 1)
+        if k < 1:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+
+        # the entries of the lists of the query's bins, gathered in one go
+        query = _query_row(self.histograms, idx)
+        bins = np.flatnonzero(query)
+        starts, lengths = self.postings.indptr[bins], np.diff(self.postings.indptr)[bins]
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        p, q = self.postings.data[entries], np.repeat(query[bins], lengths)
+
+        # Images that share no bin with the query keep a score of 0 and are at the largest distance of 1
+        shared = np.minimum(p, q) if self.metric == 'intersection' else p * q / (p + q)
+        scores = np.bincount(self.postings.indices[entries], shared, minlength=n_images)
+        distances = 1.0 - scores if self.metric == 'intersection' else 1.0 - 2 * scores
+        distances[idx] = np.inf
+
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+        return nearest, distances[nearest]
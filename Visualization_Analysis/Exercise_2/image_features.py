@@ -0,0 +1,564 @@
+import os
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+from scipy import sparse
+
+from worker_processes import process_context
+
+
+def open_image(path, draft_scale=1, max_pixels=None):
+    """
+    Opens an image as RGB, optionally decoding it at a reduced resolution. For JPEGs the reduction happens in the
+    decoder (PIL draft mode, which skips most of the decoding work for scales of 2, 4 or 8), other formats are decoded
+    completely and then reduced.
+
+    :param path: Path of the image file
+    :param draft_scale: Factor the width and height are at least divided by, 1 decodes the full resolution
+    :param max_pixels: Maximal number of pixels of the decoded image, if None there is no limit
+    :return: A PIL image in RGB mode
+    """
+    img = Image.open(path)
+
+    width, height = img.size
+    scale = draft_scale
+    if max_pixels is not None and width * height / scale**2 > max_pixels:
+        scale = np.sqrt(width * height / max_pixels)
+
+    if scale > 1:
+        img.draft('RGB', (max(1, int(width / scale)), max(1, int(height / scale))))
+        # draft only reduces by powers of two and only for JPEGs, reduce takes care of the rest (the small tolerance
+        # avoids an extra reduction when draft could only round the size up by a pixel)
+        factor = int(np.ceil(scale * img.size[0] / width - 0.01))
+        if factor > 1:
+            img = img.reduce(factor)
+
+    # Grayscale, palette, CMYK or RGBA images are converted, so that every image has three channels
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
+def image_pixels(img) -> np.ndarray:
+    """
+    Returns the pixels of an opened image.
+
+    :param img: A PIL image in RGB mode
+    :return: An N_Pixel x 3 uint8 array
+    """
+    # Convert the image into a numpy array and reshape it such that we have an array with the dimensions (N_Pixel, 3)
+    a = np.asarray(img)
+    return np.reshape(a, (a.shape[0]*a.shape[1], 3))
+
+
+def load_pixels(path, draft_scale=1, max_pixels=None) -> np.ndarray:
+    """
+    Decodes an image into its pixels.
+
+    :param path: Path of the image file
+    :param draft_scale: Resolution reduction passed to open_image
+    :param max_pixels: Pixel budget passed to open_image
+    :return: An N_Pixel x 3 uint8 array
+    """
+    # open image using PILs Image package
+    return image_pixels(open_image(path, draft_scale, max_pixels))
+
+
+def thumbnail_path(path, thumbnail_dir) -> str:
+    """
+    Path of the thumbnail of an image.
+
+    :param path: Path of the image file
+    :param thumbnail_dir: Directory of the thumbnails
+    :return: The path of the thumbnail, which has the same file name as the image
+    """
+    return os.path.join(thumbnail_dir, os.path.basename(path))
+
+
+def save_thumbnail(img, path, size):
+    """
+    Saves a downscaled copy of an image as JPEG.
+
+    :param img: A PIL image in RGB mode
+    :param path: Path of the thumbnail
+    :param size: (width, height) of the thumbnail, the glyphs stretch every image to a fixed size anyway, so the aspect
+        ratio is not kept
+    """
+    # BOX averages all source pixels of a target pixel, which is exact and fast for large downscaling factors
+    img.resize(size, Image.BOX).save(path, 'JPEG', quality=85, optimize=True)
+
+
+def numpy_histograms(pixels, n_bins_color, n_bins_channel) -> tuple:
+    """
+    Reference implementation of the histograms with np.histogramdd and np.histogram, used to check the fused kernel.
+
+    :param pixels: An N_Pixel x 3 uint8 array
+    :param n_bins_color: Number of bins per color for the 3D histogram
+    :param n_bins_channel: Number of bins per channel for the channel histograms
+    :return: A tuple of the flattened color histogram with n_bins_color^3 bins and the 3 x n_bins_channel channel
+        histograms
+    """
+    # Compute a multi dimensional histogram for the pixels, which returns a cube
+    # reference: https://numpy.org/doc/stable/reference/generated/numpy.histogramdd.html
+    hist_col, _ = np.histogramdd(pixels, (n_bins_color, n_bins_color, n_bins_color), ((0, 255), (0, 255), (0, 255)))
+
+    # Compute a "normal" histogram for each color channel (rgb)
+    # reference: https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
+    hist_r, _ = np.histogram(pixels[:, 0], bins=n_bins_channel, range=(0, 255))
+    hist_g, _ = np.histogram(pixels[:, 1], bins=n_bins_channel, range=(0, 255))
+    hist_b, _ = np.histogram(pixels[:, 2], bins=n_bins_channel, range=(0, 255))
+
+    # However, later used methods do not accept multi dimensional arrays, so reshape the cube to only have one row
+    return np.reshape(hist_col, (n_bins_color**3)), np.array([hist_r, hist_g, hist_b])
+
+
+@lru_cache(maxsize=None)
+def _bin_lookup(n_bins) -> np.ndarray:
+    # Bin index of every uint8 value. The edges are the ones np.histogram and np.histogramdd use for the range (0, 255):
+    # a value belongs to the last edge that is smaller or equal to it and 255 itself falls into the last bin.
+    edges = np.linspace(0, 255, n_bins + 1)
+    lookup = np.searchsorted(edges, np.arange(256), side='right') - 1
+    return np.minimum(lookup, n_bins - 1)
+
+
+@lru_cache(maxsize=None)
+def _color_lookups(n_bins_color) -> tuple:
+    # Per channel lookup tables that map a uint8 value directly to its contribution to the flat index of the color cube
+    lookup = _bin_lookup(n_bins_color).astype(np.int32)
+    return lookup * n_bins_color**2, lookup * n_bins_color, lookup
+
+
+@lru_cache(maxsize=None)
+def _channel_binning(n_bins_channel) -> np.ndarray:
+    # 256 x n_bins_channel 0/1 matrix that sums the counts of the single uint8 values into the channel bins
+    binning = np.zeros((256, n_bins_channel), dtype=np.int64)
+    binning[np.arange(256), _bin_lookup(n_bins_channel)] = 1
+    return binning
+
+
+def histograms_from_pixels(pixel_arrays, n_bins_color, n_bins_channel) -> tuple:
+    """
+    Computes the color and channel histograms of a batch of images in one fused integer kernel. Every pixel is quantized
+    once through lookup tables and all histograms of the batch are counted with np.bincount, the results are identical
+    to numpy_histograms.
+
+    :param pixel_arrays: A list of N_Pixel x 3 uint8 arrays, one per image
+    :param n_bins_color: Number of bins per color for the 3D histogram
+    :param n_bins_channel: Number of bins per channel for the channel histograms
+    :return: A tuple of the batch x n_bins_color^3 color histograms and the batch x 3 x n_bins_channel channel
+        histograms, both as int64 counts
+    """
+    n_color = n_bins_color**3
+    lookup_r, lookup_g, lookup_b = _color_lookups(n_bins_color)
+
+    # The flat color cube index of every pixel of the batch, shifted by n_color per image so that a single bincount
+    # counts the histograms of all images at once
+    codes = np.empty(sum(len(pixels) for pixels in pixel_arrays), dtype=np.int64)
+    values = np.empty((len(pixel_arrays), 3, 256), dtype=np.int64)
+    offset = 0
+    for idx, pixels in enumerate(pixel_arrays):
+        image_codes = codes[offset:offset + len(pixels)]
+        np.add(lookup_r[pixels[:, 0]], lookup_g[pixels[:, 1]], out=image_codes)
+        image_codes += lookup_b[pixels[:, 2]]
+        image_codes += idx * n_color
+        offset += len(pixels)
+
+        # The channel histograms are first counted per uint8 value and binned afterwards
+        for channel in range(3):
+            values[idx, channel] = np.bincount(pixels[:, channel], minlength=256)
+
+    color = np.bincount(codes, minlength=len(pixel_arrays) * n_color).reshape(len(pixel_arrays), n_color)
+    channel = values @ _channel_binning(n_bins_channel)
+
+    return color, channel
+
+
+# Histogram arrays of a worker process, which are views on the shared memory blocks of the parent process
+_worker_arrays = {}
+
+
+def _attach_shared_arrays(color_spec, channel_spec, *config):
+    # Runs once per worker process. The SharedMemory objects are kept alive as long as the worker, otherwise the views
+    # would point to unmapped memory.
+    for key, (name, shape) in (('color', color_spec), ('channel', channel_spec)):
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_arrays[key] = (shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf))
+    _worker_arrays['config'] = config
+
+
+def _fill_rows(start, paths, color_histograms, channel_histograms, n_bins_color, n_bins_channel, batch_size,
+               thumbnail_dir, thumbnail_size, draft_scale, max_pixels):
+    # Decodes the images batch by batch, writes their histograms to the rows starting at start and saves their
+    # thumbnails while the decoded images are at hand
+    for batch_start in range(0, len(paths), batch_size):
+        batch = paths[batch_start:batch_start + batch_size]
+        images = [open_image(path, draft_scale, max_pixels) for path in batch]
+        color, channel = histograms_from_pixels([image_pixels(img) for img in images], n_bins_color, n_bins_channel)
+        rows = slice(start + batch_start, start + batch_start + len(batch))
+        color_histograms[rows] = color
+        channel_histograms[rows] = channel
+
+        if thumbnail_dir is not None:
+            for path, img in zip(batch, images):
+                save_thumbnail(img, thumbnail_path(path, thumbnail_dir), thumbnail_size)
+
+
+def _extract_chunk(chunk):
+    # Each task writes the histograms of a contiguous range of images to their rows in the shared arrays, so the result
+    # has the same order as the paths no matter in which order the tasks finish
+    start, paths = chunk
+    _fill_rows(start, paths, _worker_arrays['color'][1], _worker_arrays['channel'][1], *_worker_arrays['config'])
+    return len(paths)
+
+
+def extract_histograms(paths, color_histograms, channel_histograms, workers=None, chunk_size=None, batch_size=8,
+                       thumbnail_dir=None, thumbnail_size=(64, 40), draft_scale=1, max_pixels=None):
+    """
+    Fills the color and channel histogram arrays in place, spreading the images across a pool of worker processes.
+
+    :param paths: List of image paths, row i of the histogram arrays belongs to paths[i]
+    :param color_histograms: An N x n_bins_color^3 array
+    :param channel_histograms: An N x 3 x n_bins_channel array
+    :param workers: Number of worker processes, if None one per CPU core is used and if 1 the images are processed in
+        this process
+    :param chunk_size: Number of consecutive images per task, if None it is chosen such that every worker gets about
+        four tasks
+    :param batch_size: Number of images that are passed to histograms_from_pixels at once
+    :param thumbnail_dir: Directory the thumbnails of the images are saved to, if None no thumbnails are created
+    :param thumbnail_size: (width, height) of the thumbnails
+    :param draft_scale: Resolution reduction of the decoding, see open_image
+    :param max_pixels: Pixel budget of the decoding, see open_image
+    """
+    n = len(paths)
+    n_bins_color = round(color_histograms.shape[1] ** (1 / 3))
+    n_bins_channel = channel_histograms.shape[2]
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, n)
+    config = (n_bins_color, n_bins_channel, batch_size, thumbnail_dir, thumbnail_size, draft_scale, max_pixels)
+    if thumbnail_dir is not None:
+        os.makedirs(thumbnail_dir, exist_ok=True)
+
+    if workers <= 1:
+        _fill_rows(0, paths, color_histograms, channel_histograms, *config)
+        return
+
+    if chunk_size is None:
+        chunk_size = max(1, min(256, -(-n // (4 * workers))))
+    chunks = [(start, paths[start:start + chunk_size]) for start in range(0, n, chunk_size)]
+
+    # The workers write into shared memory, so no histogram is pickled back to this process
+    blocks = []
+    try:
+        specs = []
+        for shape in (color_histograms.shape, channel_histograms.shape):
+            shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8))
+            blocks.append(shm)
+            specs.append((shm.name, shape))
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=process_context(), initializer=_attach_shared_arrays,
+                                 initargs=(*specs, *config)) as executor:
+            for _ in executor.map(_extract_chunk, chunks):
+                pass
+
+        color_histograms[...] = np.ndarray(color_histograms.shape, dtype=np.float64, buffer=blocks[0].buf)
+        channel_histograms[...] = np.ndarray(channel_histograms.shape, dtype=np.float64, buffer=blocks[1].buf)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+# Storage layouts of the color histograms: 'dense64' is the plain float64 array, 'dense32' halves it and 'sparse' keeps
+# only the occupied bins of every image in a float32 CSR matrix
+COLOR_STORAGES = ('dense64', 'dense32', 'sparse')
+
+
+def pack_histograms(histograms, storage='sparse'):
+    """
+    Converts an array of flat histograms to the given storage layout.
+
+    :param histograms: An N x B array or sparse matrix of histograms
+    :param storage: One of COLOR_STORAGES
+    :return: A float64 or float32 array, or a float32 CSR matrix
+    """
+    if storage == 'sparse':
+        return sparse.csr_matrix(histograms, dtype=np.float32)
+    if storage not in COLOR_STORAGES:
+        raise ValueError('unknown storage {!r}, expected one of {}'.format(storage, COLOR_STORAGES))
+
+    dtype = np.float64 if storage == 'dense64' else np.float32
+    if sparse.issparse(histograms):
+        return histograms.toarray().astype(dtype, copy=False)
+    return np.asarray(histograms, dtype=dtype)
+
+
+def normalize_histograms(histograms, norm='l1'):
+    """
+    Creates a normalized variant of the histograms without densifying sparse ones.
+
+    :param histograms: An N x B array or sparse matrix of histograms
+    :param norm: 'l1' divides every histogram by its number of pixels, 'sqrt' additionally takes the square root (the
+        Hellinger embedding, in which euclidean distances compare distributions), None returns the histograms unchanged
+    :return: The normalized histograms in the same layout
+    """
+    if norm is None:
+        return histograms
+    if norm not in ('l1', 'sqrt'):
+        raise ValueError('unknown norm {!r}, expected None, l1 or sqrt'.format(norm))
+
+    totals = np.asarray(histograms.sum(axis=1), dtype=np.float64).ravel()
+    scale = np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0)
+    if sparse.issparse(histograms):
+        normalized = sparse.diags(scale.astype(histograms.dtype)) @ histograms
+        normalized = normalized.tocsr()
+        if norm == 'sqrt':
+            normalized.data = np.sqrt(normalized.data)
+    else:
+        normalized = histograms * scale.astype(histograms.dtype)[:, np.newaxis]
+        if norm == 'sqrt':
+            normalized = np.sqrt(normalized)
+    return normalized
+
+
+def storage_bytes(histograms) -> int:
+    """
+    Memory used by histograms in one of the storage layouts.
+
+    :param histograms: An array or CSR matrix
+    :return: The number of bytes
+    """
+    if sparse.issparse(histograms):
+        return histograms.data.nbytes + histograms.indices.nbytes + histograms.indptr.nbytes
+    return histograms.nbytes
+
+
+def storage_report(histograms) -> str:
+    """
+    Compares the memory the histograms take in every storage layout. Only the sparse layout is built, the sizes of the
+    dense ones follow from the shape.
+
+    :param histograms: An N x B array or sparse matrix of histograms
+    :return: A multi line report with the total and per image size of every layout
+    """
+    n, n_bins = histograms.shape
+    lines = []
+    for storage in COLOR_STORAGES:
+        if storage == 'sparse':
+            n_bytes = storage_bytes(pack_histograms(histograms, storage))
+        else:
+            n_bytes = n * n_bins * np.dtype(np.float64 if storage == 'dense64' else np.float32).itemsize
+        lines.append('{:>8}: {:10.1f} MB, {:8.1f} KB per image, {:8.1f} GB per million images'.format(
+            storage, n_bytes / 2**20, n_bytes / max(n, 1) / 2**10, n_bytes / max(n, 1) * 1e6 / 2**30))
+    return '\n'.join(lines)
+
+
+def _take_rows(histograms, rows):
+    # Row selection that works for arrays and CSR matrices alike
+    return histograms[np.asarray(rows, dtype=np.intp)]
+
+
+def _stack_rows(blocks):
+    # Row concatenation that works for arrays and CSR matrices alike
+    if any(sparse.issparse(block) for block in blocks):
+        return sparse.vstack(blocks, format='csr')
+    return np.concatenate(blocks)
+
+
+class FeatureStore:
+    """
+    On-disk store of the histograms of the images and of the last embeddings and similarity index computed from them.
+    The rows are keyed by image path, file size and modification time, so only new or changed images have to be
+    processed again.
+
+    :param path: Path of the .npz file of the store
+    :param n_bins_color: Number of bins per color for the 3D histograms
+    :param n_bins_channel: Number of bins per channel for the channel histograms
+    :param color_storage: Storage layout of the color histograms, one of COLOR_STORAGES
+    :param block_size: Number of new images whose color histograms are held as dense float64 array before they are
+        packed, this bounds the memory of the extraction for large collections
+    :param thumbnail_dir: Directory of the thumbnails that are created along with the histograms, if None no
+        thumbnails are created
+    :param thumbnail_size: (width, height) of the thumbnails
+    :param draft_scale: Resolution reduction of the decoding, see open_image
+    :param max_pixels: Pixel budget of the decoding, see open_image
+    """
+
+    def __init__(self, path, n_bins_color, n_bins_channel, color_storage='sparse', block_size=4096,
+                 thumbnail_dir=None, thumbnail_size=(64, 40), draft_scale=1, max_pixels=None):
+        self.path = path
+        self.n_bins_color = n_bins_color
+        self.n_bins_channel = n_bins_channel
+        self.color_storage = color_storage
+        self.block_size = block_size
+        self.thumbnail_dir = thumbnail_dir
+        self.thumbnail_size = tuple(thumbnail_size)
+        self.draft_scale = draft_scale
+        self.max_pixels = max_pixels
+        self.paths = []
+        self.stats = np.zeros((0, 2), dtype=np.int64)
+        self.color_histograms = pack_histograms(np.zeros((0, n_bins_color**3)), color_storage)
+        self.channel_histograms = np.zeros((0, 3, n_bins_channel))
+        self.embeddings = {}
+        # inverted file of the similarity index, see embedding.SimilarityIndex
+        self.similarity_postings = None
+
+    def load(self):
+        # A missing or unreadable store, or one computed with other bin counts or another decoding, is treated as empty
+        try:
+            with np.load(self.path, allow_pickle=False) as store:
+                if tuple(store['n_bins']) != (self.n_bins_color, self.n_bins_channel):
+                    return
+                if tuple(store['decoding']) != (self.draft_scale, self.max_pixels or 0):
+                    return
+                if self.thumbnail_dir is not None and tuple(store['thumbnail_size']) != self.thumbnail_size:
+                    return
+                if 'color_data' in store.files:
+                    color_histograms = sparse.csr_matrix(
+                        (store['color_data'], store['color_indices'], store['color_indptr']),
+                        shape=(len(store['paths']), self.n_bins_color**3))
+                else:
+                    color_histograms = store['color_histograms']
+                self.paths = store['paths'].tolist()
+                self.stats = store['stats']
+                self.color_histograms = pack_histograms(color_histograms, self.color_storage)
+                self.channel_histograms = store['channel_histograms']
+                self.embeddings = {key[len('embedding_'):]: store[key] for key in store.files
+                                   if key.startswith('embedding_')}
+                if 'postings_data' in store.files:
+                    self.similarity_postings = sparse.csr_matrix(
+                        (store['postings_data'], store['postings_indices'], store['postings_indptr']),
+                        shape=(self.n_bins_color**3, len(self.paths)))
+        except (OSError, KeyError, ValueError):
+            pass
+
+    def save(self):
+        if sparse.issparse(self.color_histograms):
+            color = dict(color_data=self.color_histograms.data, color_indices=self.color_histograms.indices,
+                         color_indptr=self.color_histograms.indptr)
+        else:
+            color = dict(color_histograms=self.color_histograms)
+        postings = {}
+        if self.similarity_postings is not None:
+            postings = dict(postings_data=self.similarity_postings.data,
+                            postings_indices=self.similarity_postings.indices,
+                            postings_indptr=self.similarity_postings.indptr)
+
+        # Writing to a temporary file first, so that an interrupted save never leaves a broken store behind
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            np.savez(fh, n_bins=np.array([self.n_bins_color, self.n_bins_channel]),
+                     thumbnail_size=np.array(self.thumbnail_size),
+                     decoding=np.array([self.draft_scale, self.max_pixels or 0]),
+                     paths=np.array(self.paths, dtype=str), stats=self.stats,
+                     channel_histograms=self.channel_histograms, **color, **postings,
+                     **{'embedding_' + name: coords for name, coords in self.embeddings.items()})
+        os.replace(tmp_path, self.path)
+
+    def update(self, paths, workers=None) -> bool:
+        """
+        Brings the store in line with the given images: the histograms and thumbnails of new or changed images are
+        computed, the ones of deleted images are pruned and the rows are reordered to match paths. The store is saved
+        if anything changed.
+
+        :param paths: List of image paths
+        :param workers: Number of worker processes passed to extract_histograms
+        :return: True if the images are unchanged since the last save, i.e. the stored embeddings are still valid
+        """
+        stats = np.array([[st.st_size, st.st_mtime_ns] for st in map(os.stat, paths)], dtype=np.int64).reshape(-1, 2)
+        old_rows = {path: row for row, path in enumerate(self.paths)}
+
+        rows = np.full(len(paths), -1)
+        for idx, path in enumerate(paths):
+            row = old_rows.get(path, -1)
+            if row >= 0 and np.array_equal(self.stats[row], stats[idx]) and (
+                    self.thumbnail_dir is None or os.path.exists(thumbnail_path(path, self.thumbnail_dir))):
+                rows[idx] = row
+
+        unchanged = list(paths) == self.paths and bool(np.all(rows >= 0))
+        if unchanged:
+            return True
+
+        # The histograms of the new images are computed block by block and appended after the stored ones, rows then
+        # maps every image to its row in this combined array
+        color_blocks = [self.color_histograms]
+        channel_blocks = [self.channel_histograms]
+        missing = np.flatnonzero(rows < 0)
+        next_row = len(self.paths)
+        for block_start in range(0, len(missing), self.block_size):
+            block = missing[block_start:block_start + self.block_size]
+            block_color = np.zeros((len(block), self.n_bins_color**3))
+            block_channel = np.zeros((len(block), 3, self.n_bins_channel))
+            extract_histograms([paths[idx] for idx in block], block_color, block_channel, workers=workers,
+                               thumbnail_dir=self.thumbnail_dir, thumbnail_size=self.thumbnail_size,
+                               draft_scale=self.draft_scale, max_pixels=self.max_pixels)
+            color_blocks.append(pack_histograms(block_color, self.color_storage))
+            channel_blocks.append(block_channel)
+            rows[block] = np.arange(next_row, next_row + len(block))
+            next_row += len(block)
+
+        if self.thumbnail_dir is not None:
+            for path in set(self.paths) - set(paths):
+                if os.path.exists(thumbnail_path(path, self.thumbnail_dir)):
+                    os.remove(thumbnail_path(path, self.thumbnail_dir))
+
+        self.paths = list(paths)
+        self.stats = stats
+        self.color_histograms = _take_rows(_stack_rows(color_blocks), rows)
+        self.channel_histograms = _take_rows(np.concatenate(channel_blocks), rows)
+        self.embeddings = {}
+        self.similarity_postings = None
+        self.save()
+        return False
+
+
+def _sum_rows(histograms, rows) -> np.ndarray:
+    # Sum of the selected rows in float64, for arrays as well as CSR matrices (whose sum is a 1 x B matrix)
+    if sparse.issparse(histograms):
+        return np.asarray(histograms[rows].sum(axis=0, dtype=np.float64)).ravel()
+    return np.sum(histograms[rows], axis=0, dtype=np.float64)
+
+
+class SelectionSum:
+    """
+    Running sum of the histograms of the selected images. A new selection is applied by adding the histograms of the
+    images that entered it and subtracting the ones of the images that left it, so the cost of an update depends on the
+    size of the change and not on the size of the selection.
+
+    :param histograms: An N x ... array of histograms or an N x B sparse matrix
+    """
+
+    def __init__(self, histograms):
+        self.histograms = histograms
+        self.total = _sum_rows(histograms, slice(None))
+        self.selected = np.zeros(histograms.shape[0], dtype=bool)
+        self.sum = np.zeros_like(self.total)
+        self.count = 0
+
+    def update(self, selection) -> tuple:
+        """
+        Moves the running sum to a new selection.
+
+        :param selection: A list of selected indices, an empty selection stands for all images
+        :return: A tuple of the sum of the histograms of the selection and the number of selected images
+        """
+        selected = np.zeros(self.histograms.shape[0], dtype=bool)
+        selected[np.asarray(selection, dtype=np.intp)] = True
+        count = int(np.count_nonzero(selected))
+
+        changed = selected ^ self.selected
+        n_changed = int(np.count_nonzero(changed))
+        if n_changed > count:
+            # Fall back to a full recompute when summing the selection is cheaper than applying the difference
+            self.sum = _sum_rows(self.histograms, selected)
+        elif n_changed > 0:
+            self.sum += _sum_rows(self.histograms, changed & selected)
+            self.sum -= _sum_rows(self.histograms, changed & self.selected)
+        self.selected = selected
+        self.count = count
+
+        if count == 0:
+            return self.total, self.histograms.shape[0]
+        return self.sum, count
@@ -1,15 +1,15 @@
 import glob
 import os
 import numpy as np
-from PIL import Image
-
-from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA
 
 from bokeh.plotting import figure, curdoc
 from bokeh.models import ColumnDataSource
+from bokeh.events import Tap
 from bokeh.layouts import layout
 
+from image_features import FeatureStore, SelectionSum, normalize_histograms, thumbnail_path
+from embedding import SimilarityIndex, compute_embeddings, format_timings
+
 # You might want to implement a helper function for the update function below or you can do all the calculations in the
 # update callback function.
 def channel_hist_data_for_selection(selection=None) -> dict:
@@ -19,11 +19,9 @@ def channel_hist_data_for_selection(selection=None) -> dict:
     :param selection: An list of selected indices in the dataset, if None the complete dataset is returned
     :return: A dict to pass into the ColumnDataSource
     """
-    if not selection:
-        selection = [*range(N)]
-
-    ys = np.sum(channel_histograms[selection, ...], axis=0)
-    ys /= len(selection)
+    # The running sum only adds and subtracts the histograms of the images that entered or left the selection
+    ys, count = selection_sum.update(selection or [])
+    ys = ys / count
     ys /= np.amax(ys)
 
     xs = np.arange(N_BINS_CHANNEL)
@@ -48,8 +46,72 @@ def update(attr, old, new):
     hist_source.data = channel_hist_data_for_selection(new)
 
 
-# Fetch the number of images using glob or some other path analyzer
-N = len(glob.glob("static/*.jpg"))
+def lod_data_for_viewport(xs, ys, x_range, y_range) -> dict:
+    """
+    Picks the points that are drawn as image glyphs: the ones inside the current viewport, capped at MAX_IMAGE_GLYPHS.
+
+    :param xs: x coordinates of all images
+    :param ys: y coordinates of all images
+    :param x_range: The x range of the figure, its start and end are None until the browser reported them
+    :param y_range: The y range of the figure
+    :return: A dict to pass into the ColumnDataSource of the image glyphs
+    """
+    # The points are tested in the order of a fixed random permutation, so the capped glyphs are a uniform sample of
+    # the viewport that stays the same while the user pans over the same region
+    xs_ordered = xs[lod_order]
+    ys_ordered = ys[lod_order]
+    inside = np.ones(N, dtype=bool)
+    for coords, bounds in ((xs_ordered, x_range), (ys_ordered, y_range)):
+        if bounds.start is not None and bounds.end is not None:
+            low, high = sorted((bounds.start, bounds.end))
+            inside &= (coords >= low) & (coords <= high)
+
+    idx = lod_order[np.flatnonzero(inside)[:MAX_IMAGE_GLYPHS]]
+    return dict(x=xs[idx], y=ys[idx], thumbs=[thumb_paths[i] for i in idx])
+
+
+def update_lod(name):
+    # Range changes arrive as up to four events per pan or zoom step (start and end of both axes), so the image glyphs
+    # of a figure are recomputed once on the next tick instead of once per event
+    def schedule(attr, old, new):
+        if name not in lod_pending:
+            lod_pending.add(name)
+            curdoc().add_next_tick_callback(lambda: refresh_lod(name))
+    return schedule
+
+
+def refresh_lod(name):
+    lod_pending.discard(name)
+    fig, source, xs, ys = lod_figures[name]
+    source.data = lod_data_for_viewport(xs, ys, fig.x_range, fig.y_range)
+
+
+def similar_data_for_image(idx) -> dict:
+    """
+    Finds the images with the most similar color histograms.
+
+    :param idx: Index of the query image
+    :return: A dict to pass into the ColumnDataSource of the similar images, the query image comes first
+    """
+    neighbors, distances = similarity_index.query(idx, N_SIMILAR)
+    idx = np.concatenate([[idx], neighbors])
+    return dict(x=np.arange(len(idx)) + 0.5, thumbs=[thumb_paths[i] for i in idx],
+                labels=['query'] + ['{:.3f}'.format(distance) for distance in distances])
+
+
+def show_similar(xs, ys, fig):
+    # Taps anywhere on the figure pick the closest point, measured relative to the visible range of both axes
+    def callback(event):
+        x_span = abs(fig.x_range.end - fig.x_range.start) if fig.x_range.start is not None else 1.0
+        y_span = abs(fig.y_range.end - fig.y_range.start) if fig.y_range.start is not None else 1.0
+        idx = int(np.argmin(((xs - event.x) / x_span) ** 2 + ((ys - event.y) / y_span) ** 2))
+        similar_source.data = similar_data_for_image(idx)
+    return callback
+
+
+# Fetch the image paths once, sorted so that the row order of the histograms is deterministic
+img_files = sorted(glob.glob("static/*.jpg"))
+N = len(img_files)
 
 # Find the root directory of your app to generate the image URL for the bokeh server
 ROOT = os.path.split(os.path.abspath("."))[1] + "/"
@@ -59,80 +121,137 @@ N_BINS_COLOR = 16
 # Number of bins per channel for the channel histograms
 N_BINS_CHANNEL = 50
 
-# Define an array containing the 3D color histograms. We have one histogram per image each having N_BINS_COLOR^3 bins.
-# i.e. an N * N_BINS_COLOR^3 array
-color_histograms = np.zeros((N, N_BINS_COLOR**3))
+# Number of worker processes for the histogram computation, None uses one per CPU core
+N_WORKERS = None
+
+# File of the feature store that keeps the histograms and embeddings between restarts of the app
+FEATURE_STORE = "features.npz"
+
+# Resolution reduction of the image decoding for the histograms: JPEGs are decoded at 1/DRAFT_SCALE of their width and
+# height and at most MAX_PIXELS pixels (None for no limit), which is plenty for 16 bins per color
+DRAFT_SCALE = 4
+MAX_PIXELS = 1_000_000
+
+# Storage layout of the color histograms (one of image_features.COLOR_STORAGES), 'sparse' only keeps the occupied bins
+COLOR_STORAGE = 'sparse'
+
+# Directory and size of the downscaled copies of the images that the glyphs display, the glyphs are 32 x 20 screen
+# pixels so twice that resolution is enough for high density screens
+THUMBNAIL_DIR = "static/thumbs"
+THUMBNAIL_SIZE = (64, 40)
+
+# The image and thumbnail urls for the server, in the same order as the rows of the histogram arrays
+img_paths = [ROOT + f for f in img_files]
+thumb_paths = [ROOT + thumbnail_path(f, THUMBNAIL_DIR) for f in img_files]
+
+# Load the stored features and compute the color and channel histograms and thumbnails only for new or changed images,
+# each worker fills its rows of the histogram arrays
+store = FeatureStore(FEATURE_STORE, N_BINS_COLOR, N_BINS_CHANNEL, color_storage=COLOR_STORAGE,
+                     thumbnail_dir=THUMBNAIL_DIR, thumbnail_size=THUMBNAIL_SIZE, draft_scale=DRAFT_SCALE,
+                     max_pixels=MAX_PIXELS)
+store.load()
+images_unchanged = store.update(img_files, workers=N_WORKERS)
+
+# The array containing the 3D color histograms. We have one histogram per image each having N_BINS_COLOR^3 bins.
+# i.e. an N * N_BINS_COLOR^3 array, or a sparse matrix of that shape
+color_histograms = store.color_histograms
 
-# Define an array containing the channel histograms, there is one per image each having 3 channel and N_BINS_CHANNEL
+# The array containing the channel histograms, there is one per image each having 3 channel and N_BINS_CHANNEL
 # bins i.e an N x 3 x N_BINS_CHANNEL array
-channel_histograms = np.zeros((N, 3, N_BINS_CHANNEL))
-
-# initialize an empty list for the image file paths
-img_paths = []
-
-# Compute the color and channel histograms
-for idx, f in enumerate(glob.glob("static/*.jpg")):
-    # open image using PILs Image package
-    img = Image.open(f)
-    # Convert the image into a numpy array and reshape it such that we have an array with the dimensions (N_Pixel, 3)
-    a = np.asarray(img)
-    pixels = np.reshape(a, (a.shape[0]*a.shape[1], 3))
-
-    # Compute a multi dimensional histogram for the pixels, which returns a cube
-    # reference: https://numpy.org/doc/stable/reference/generated/numpy.histogramdd.html
-    hist_col, _ = np.histogramdd(pixels, (N_BINS_COLOR, N_BINS_COLOR, N_BINS_COLOR), ((0, 255), (0, 255), (0, 255)))
-
-    print(hist_col.shape)
-    # However, later used methods do not accept multi dimensional arrays, so reshape it to only have columns and rows
-    # (N_Images, N_BINS^3) and add it to the color_histograms array you defined earlier
-    color_histograms[idx] = np.reshape(hist_col, (N_BINS_COLOR**3))
-
-    # Append the image url to the list for the server
-    url = ROOT + f
-    img_paths.append(url)
-
-    # Compute a "normal" histogram for each color channel (rgb)
-    # reference: https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
-    hist_r, _ = np.histogram(pixels[:, 0], bins=N_BINS_CHANNEL, range=(0, 255))
-    hist_g, _ = np.histogram(pixels[:, 1], bins=N_BINS_CHANNEL, range=(0, 255))
-    hist_b, _ = np.histogram(pixels[:, 2], bins=N_BINS_CHANNEL, range=(0, 255))
-    # and add them to the channel_histograms
-    channel_histograms[idx] = [hist_r, hist_g, hist_b]
-
-# Calculate the indicated dimensionality reductions
+channel_histograms = store.channel_histograms
+
+# Number of similar images shown for a tapped image and the histogram distance they are ranked by (one of
+# embedding.SIMILARITY_METRICS)
+N_SIMILAR = 8
+SIMILARITY_METRIC = 'intersection'
+
+# Index of the color distributions for the similarity search, an inverted file of the color bins. It is built once
+# after the images changed and then loaded with the store.
+similarity_index = SimilarityIndex(normalize_histograms(color_histograms, 'l1'), SIMILARITY_METRIC,
+                                   postings=store.similarity_postings)
+if store.similarity_postings is None:
+    store.similarity_postings = similarity_index.postings
+    store.save()
+
+# PCA engine of the dimensionality reductions (one of embedding.PCA_MODES) and the data type of the features, t-SNE
+# starts from the PCA result and runs on the first TSNE_INPUT_DIMS principal components
+PCA_MODE = 'randomized'
+FEATURE_DTYPE = np.float32
+TSNE_INPUT_DIMS = 50
+
+# Normalization of the color histograms before the reductions: None uses the pixel counts, 'l1' the color distribution
+# and 'sqrt' its square root
+COLOR_NORMALIZATION = None
+
+# Embeddings are stored per configuration, so changing it above recomputes them
+embedding_key = '{}_{}_{}_{}'.format(PCA_MODE, np.dtype(FEATURE_DTYPE).name, TSNE_INPUT_DIMS, COLOR_NORMALIZATION)
+
+# Calculate the indicated dimensionality reductions, unless the images did not change since they were stored
 # references:
 # https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
 # https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html
-coords_tsne = TSNE().fit_transform(color_histograms)
-coords_pca = PCA().fit_transform(color_histograms)
-
-
-# Construct a data source containing the dimensional reduction result for both the t-SNE and the PCA and the image paths
+if images_unchanged and {'tsne_' + embedding_key, 'pca_' + embedding_key} <= store.embeddings.keys():
+    coords_tsne = store.embeddings['tsne_' + embedding_key]
+    coords_pca = store.embeddings['pca_' + embedding_key]
+else:
+    coords, timings = compute_embeddings(normalize_histograms(color_histograms, COLOR_NORMALIZATION),
+                                         pca_mode=PCA_MODE, dtype=FEATURE_DTYPE, tsne_input_dims=TSNE_INPUT_DIMS)
+    print(format_timings(timings))
+    coords_tsne, coords_pca = coords['tsne'], coords['pca']
+    store.embeddings = {'tsne_' + embedding_key: coords_tsne, 'pca_' + embedding_key: coords_pca}
+    store.save()
+
+
+# Construct a data source containing the dimensional reduction result for both the t-SNE and the PCA, the image paths
+# and the thumbnail paths
 dimred_source = ColumnDataSource(dict(
     xs_tsne=coords_tsne[:, 0], ys_tsne=coords_tsne[:, 1],
     xs_pca=coords_pca[:, 0], ys_pca=coords_pca[:, 1],
-    paths=img_paths
+    paths=img_paths, thumbs=thumb_paths
 ))
 
+# Maximal number of image glyphs per figure. The images inside the current viewport are served as glyphs up to this
+# count, every point is also drawn as a small circle, so large collections stay interactive while panning and zooming.
+MAX_IMAGE_GLYPHS = 500
+
+# Order in which the points of the viewport are picked as image glyphs
+lod_order = np.random.default_rng(0).permutation(N)
+
 # Create a first figure for the t-SNE data. Add the lasso_select, wheel_zoom, pan and reset tools to it.
 p1 = figure(title="t-SNE", x_axis_label='x', y_axis_label='y', tools=["lasso_select", "wheel_zoom", "pan", "reset"])
 
-# And use bokehs image_url to plot the images as glyphs
-# reference: https://docs.bokeh.org/en/latest/docs/reference/models/glyphs/image_url.html
-g1 = p1.image_url(url="paths", x="xs_tsne", y="ys_tsne", h_units="screen", w_units="screen",
-                  w=32, h=20, anchor="center", source=dimred_source)
-
 # Since the lasso tool isn't working with the image_url glyph you have to add a second renderer (for example a circle
-# glyph) and set it to be completely transparent. If you use the same source for this renderer and the image_url,
-# the selection will also be reflected in the image_url source and the circle plot will be completely invisible.
-p1.circle(x="xs_tsne", y="ys_tsne", fill_alpha=0.0, line_alpha=0.0, source=dimred_source)
+# glyph). It uses the full dimensionality reduction source, so the lasso selects among all images, and it draws the
+# points that are not shown as image glyphs.
+p1.circle(x="xs_tsne", y="ys_tsne", size=5, fill_alpha=0.4, line_alpha=0.0, source=dimred_source)
+
+# And use bokehs image_url to plot the images of the viewport as glyphs, showing the thumbnails instead of the full size
+# images
+# reference: https://docs.bokeh.org/en/latest/docs/reference/models/glyphs/image_url.html
+lod_source_tsne = ColumnDataSource(dict(x=[], y=[], thumbs=[]))
+g1 = p1.image_url(url="thumbs", x="x", y="y", h_units="screen", w_units="screen",
+                  w=32, h=20, anchor="center", source=lod_source_tsne)
 
 # Create a second plot for the PCA result. As before, you need a second glyph renderer for the lasso tool.
 # Add the same tools as in figure 1
 p2 = figure(title="PCA", x_axis_label='x', y_axis_label='y', tools=["lasso_select", "wheel_zoom", "pan", "reset"])
-p2.circle(x="xs_pca", y="ys_pca", fill_alpha=0.0, line_alpha=0.0, source=dimred_source)
-p2.image_url(url="paths", x="xs_pca", y="ys_pca", h_units="screen", w_units="screen",
-             w=32, h=20, anchor="center", source=dimred_source)
+p2.circle(x="xs_pca", y="ys_pca", size=5, fill_alpha=0.4, line_alpha=0.0, source=dimred_source)
+lod_source_pca = ColumnDataSource(dict(x=[], y=[], thumbs=[]))
+p2.image_url(url="thumbs", x="x", y="y", h_units="screen", w_units="screen",
+             w=32, h=20, anchor="center", source=lod_source_pca)
+
+# Recompute the image glyphs of a figure whenever its viewport changes
+lod_pending = set()
+lod_figures = dict(tsne=(p1, lod_source_tsne, coords_tsne[:, 0], coords_tsne[:, 1]),
+                   pca=(p2, lod_source_pca, coords_pca[:, 0], coords_pca[:, 1]))
+for lod_name, (lod_figure, _, _, _) in lod_figures.items():
+    refresh_lod(lod_name)
+    for lod_range in (lod_figure.x_range, lod_figure.y_range):
+        lod_range.on_change('start', update_lod(lod_name))
+        lod_range.on_change('end', update_lod(lod_name))
+
+# Running sum of the channel histograms of the lasso selection
+selection_sum = SelectionSum(channel_histograms)
 
 # Construct a datasource containing the channel histogram data. Default value should be the selection of all images.
 # Think about how you aggregate the histogram data of all images to construct this data source
@@ -150,8 +269,21 @@ p3.line("xs", "b", color="blue", width=4, source=hist_source)
 # callback/update function to recompute the channel histogram. Also read the topmost comment for more information.
 dimred_source.selected.on_change("indices", update)
 
+# Tapping on one of the embeddings shows the closest image and its most similar images in a fourth figure, with their
+# histogram distance to it
+similar_source = ColumnDataSource(dict(x=[], thumbs=[], labels=[]))
+p4 = figure(title="Similar images", x_range=(0, N_SIMILAR + 1), y_range=(0, 1), plot_height=150, tools=[],
+            toolbar_location=None)
+p4.axis.visible = False
+p4.grid.visible = False
+p4.image_url(url="thumbs", x="x", y=0.6, h_units="screen", w_units="screen", w=96, h=60, anchor="center",
+             source=similar_source)
+p4.text(x="x", y=0.05, text="labels", text_align="center", text_font_size="9pt", source=similar_source)
+p1.on_event(Tap, show_similar(coords_tsne[:, 0], coords_tsne[:, 1], p1))
+p2.on_event(Tap, show_similar(coords_pca[:, 0], coords_pca[:, 1], p2))
+
 # Construct a layout and use curdoc() to add it to your document.
-curdoc().add_root(layout([[p1, p2, p3]], sizing_mode="scale_width"))
+curdoc().add_root(layout([[p1, p2, p3], [p4]], sizing_mode="scale_width"))
 
 # You can use the command below in the folder of your python file to start a bokeh directory app.
 # Be aware that your python file must be named main.py and that your images have to be in a subfolder name "static"
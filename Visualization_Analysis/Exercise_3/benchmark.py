@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import platform
+import time
+
+import numpy as np
+
+from kmedoids import pairwise_distances, total_cost, faster_pam, nearest_medoids, clara, clarans, kmedoids_plus_plus
+
+# Phases of the clustering that are timed and summed up to the total time, None in a report if an engine has no such
+# phase
+PHASES = ('distances', 'init', 'swap', 'assign')
+
+
+def gaussian_blobs(n, k, d=4, spread=1.0, seed=0) -> np.ndarray:
+    """
+    Creates points around k random centers.
+
+    :param n: Number of points
+    :param k: Number of blobs
+    :param d: Number of features
+    :param spread: Standard deviation of the blobs, the centers are drawn from [-10, 10]^d
+    :param seed: Seed of the centers and points
+    :return: An n x d float32 array
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-10, 10, (k, d))
+    return (centers[rng.integers(0, k, n)] + rng.normal(0, spread, (n, d))).astype(np.float32)
+
+
+def benchmark_sampling(args):
+    for n in args.sizes:
+        features = gaussian_blobs(n, args.k, seed=args.seed)
+
+        start = time.perf_counter()
+        _, pam_cost = faster_pam(pairwise_distances(features), np.arange(args.k))
+        t_pam = time.perf_counter() - start
+        print('n={}, k={}, PAM: cost {:.1f}, {:.2f}s'.format(n, args.k, pam_cost, t_pam))
+
+        for name, engine in (('CLARA', clara), ('CLARANS', clarans)):
+            start = time.perf_counter()
+            _, cost = engine(features, args.k, random_state=args.seed)
+            duration = time.perf_counter() - start
+            print('n={}, k={}, {}: cost {:.1f} ({:+.2f}% of PAM), {:.2f}s ({:.1f}x)'.format(
+                n, args.k, name, cost, 100 * (cost / pam_cost - 1), duration, t_pam / duration))
+
+
+def time_exact(features, k, seed) -> dict:
+    """
+    Times the phases of the exact clustering: the distance matrix, the k-medoids++ seeding, the swap search and the
+    assignment of all points.
+
+    :param features: An n x d array of points
+    :param k: Number of medoids
+    :param seed: Seed of the seeding
+    :return: A dict with the duration of every phase in seconds and the final cost
+    """
+    timings = {}
+    start = time.perf_counter()
+    distances = pairwise_distances(features)
+    timings['distances'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    medoids = kmedoids_plus_plus(distances, k, seed)
+    timings['init'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    medoids, cost = faster_pam(distances, medoids)
+    timings['swap'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    nearest_medoids(features, medoids)
+    timings['assign'] = time.perf_counter() - start
+
+    # a single cost evaluation, what every swap of the former brute force search paid
+    start = time.perf_counter()
+    total_cost(distances, medoids)
+    timings['cost_eval'] = time.perf_counter() - start
+    return dict(engine='pam', cost=cost, **timings)
+
+
+def time_sampled(features, k, seed) -> dict:
+    """
+    Times the phases of CLARA, for sizes whose distance matrix does not fit into memory. CLARA has no distance matrix
+    of all points and seeds the search on every sample itself, so these phases and the single cost evaluation are None
+    rather than a time that was never measured.
+
+    :param features: An n x d array of points
+    :param k: Number of medoids
+    :param seed: Seed of the samples
+    :return: A dict with the duration of every phase in seconds, None for the phases that do not exist, and the final
+        cost
+    """
+    timings = dict(distances=None, init=None, cost_eval=None)
+    start = time.perf_counter()
+    medoids, _ = clara(features, k, random_state=seed)
+    timings['swap'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cost = float(nearest_medoids(features, medoids)[1].sum())
+    timings['assign'] = time.perf_counter() - start
+    return dict(engine='clara', cost=cost, **timings)
+
+
+def format_seconds(duration) -> str:
+    # phases that an engine does not have are None
+    return '      -' if duration is None else '{:7.3f}s'.format(duration)
+
+
+def benchmark_scaling(args):
+    results = []
+    for n in args.sizes:
+        for k in args.ks:
+            if k >= n:
+                continue
+            features = gaussian_blobs(n, k, d=args.dims, seed=args.seed)
+            run = time_exact if n <= args.max_exact else time_sampled
+            result = dict(n=n, k=k, d=args.dims, **run(features, k, args.seed))
+            results.append(result)
+            print('n={n:>7}, k={k:>3}, {engine:>5}: cost {cost:12.1f}, '.format(**result)
+                  + ', '.join('{} {}'.format(phase, format_seconds(result[phase])) for phase in PHASES))
+
+    report = dict(python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+                  cpus=os.cpu_count(), seed=args.seed, results=results)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('report written to {}'.format(args.output))
+
+    if args.baseline:
+        compare_reports(args.baseline, report)
+
+
+def compare_reports(baseline_path, report):
+    """
+    Prints the change of the total time and the cost of every configuration that is also in the baseline report.
+
+    :param baseline_path: Path of a report written by an earlier run
+    :param report: The report of this run
+    """
+    with open(baseline_path) as f:
+        baseline = {(r['n'], r['k'], r['d'], r['engine']): r for r in json.load(f)['results']}
+
+    for result in report['results']:
+        old = baseline.get((result['n'], result['k'], result['d'], result['engine']))
+        if old is None:
+            continue
+        old_time, new_time = (sum(r[p] for p in PHASES if r[p] is not None) for r in (old, result))
+        print('n={:>7}, k={:>3}, {:>5}: time {:.3f}s -> {:.3f}s ({:+.1f}%), cost {:.1f} -> {:.1f} ({:+.2f}%)'.format(
+            result['n'], result['k'], result['engine'], old_time, new_time, 100 * (new_time / old_time - 1),
+            old['cost'], result['cost'], 100 * (result['cost'] / old['cost'] - 1)))
+
+
+if __name__ == '__main__':
+    # python benchmark.py sampling --sizes 1000 5000 --k 10
+    # python benchmark.py scaling --output kmedoids_benchmark.json
+    # python benchmark.py scaling --output new.json --baseline kmedoids_benchmark.json
+    parser = argparse.ArgumentParser(description='Benchmarks of the k-medoids engines')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sampling_parser = subparsers.add_parser('sampling', help='compare CLARA and CLARANS with the exact PAM')
+    sampling_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000])
+    sampling_parser.add_argument('--k', type=int, default=10)
+    sampling_parser.add_argument('--seed', type=int, default=0)
+    sampling_parser.set_defaults(run=benchmark_sampling)
+
+    scaling_parser = subparsers.add_parser('scaling', help='time the phases of the clustering on gaussian blobs and '
+                                                           'write a JSON report')
+    scaling_parser.add_argument('--sizes', type=int, nargs='+', default=[150, 1000, 10000, 100000])
+    scaling_parser.add_argument('--ks', type=int, nargs='+', default=[3, 10, 50])
+    scaling_parser.add_argument('--dims', type=int, default=4)
+    scaling_parser.add_argument('--max-exact', type=int, default=10000,
+                                help='largest n clustered with the distance matrix, larger ones use CLARA')
+    scaling_parser.add_argument('--seed', type=int, default=0)
+    scaling_parser.add_argument('--output', default='kmedoids_benchmark.json')
+    scaling_parser.add_argument('--baseline', help='report of an earlier run to compare with')
+    scaling_parser.set_defaults(run=benchmark_scaling)
+
+    args = parser.parse_args()
+    args.run(args)
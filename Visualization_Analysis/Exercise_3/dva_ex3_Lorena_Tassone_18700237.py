@@ -1,87 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+import threading
+
 import numpy as np
 from bokeh.models import ColumnDataSource, Button, Select, Div
 from bokeh.sampledata.iris import flowers
 from bokeh.plotting import figure, curdoc
 from bokeh.layouts import column, row
 
+from kmedoids import (prepare_features, pairwise_distances, faster_pam, nearest_medoids, clara, clarans,
+                      multi_start, kmedoids_plus_plus)
 
-def get_distance(p,m):
-    distance = abs(sepal_length[p]-sepal_length[m]) + abs(sepal_width[p]-sepal_width[m]) + abs(petal_length[p]-petal_length[m]) + abs(petal_width[p]-petal_width[m])
-    return distance
 
+def k_medoids():
+    # The clustering runs in the executor thread, so the server keeps serving this and every other session meanwhile
+    stop.clear()
+    button.disabled = True
+    cancel_button.disabled = False
+    div.text = 'Clustering...'
+    executor.submit(run_clustering, algorithm_select.value, data_select.value == 'True')
 
-def get_cost(meds):
-    dist_array = []
-    for m in meds:
-        distance_array = np.add(np.add(np.abs(sepal_length-sepal_length[m]), np.abs(sepal_width-sepal_width[m])), np.add(np.abs(petal_length-petal_length[m]), np.abs(petal_width-petal_width[m])))
-        dist_array.append(distance_array)
 
-    sum = 0
-    for p in data.index:
-        arr = np.array([dist_array[0][p], dist_array[1][p], dist_array[2][p]])
-        sum += min(arr)
+def cancel_clustering():
+    stop.set()
 
-    return sum
 
+def close_session(session_context):
+    # A running clustering of a closed session is stopped early and the thread of the session ends with it, the server
+    # process outlives many sessions
+    stop.set()
+    executor.shutdown(wait=False)
 
-def k_medoids():
-    # number of clusters:
-    k = 3
 
-    if data_select.value == 'False':
-        medoids = [24, 74, 124]
+def run_clustering(algorithm, random_medoids):
+    # Runs in the executor thread, the document is only changed in next tick callbacks on the server's event loop
+    result = None
+    try:
+        result = cluster(algorithm, random_medoids)
+    except Exception:
+        # the session only shows that the clustering failed, the reason goes to the server log
+        logging.exception('the clustering failed')
+    doc.add_next_tick_callback(partial(finish_clustering, result))
+
+
+def cluster(algorithm, random_medoids):
+    # number of clusters:
+    k = K
+
+    # calc best medoids, the swap search keeps the distances to the nearest and second nearest medoid of every flower
+    # so that each candidate is evaluated for all k swaps at once, and improving swaps are applied right away.
+    # Random medoids run the search from N_STARTS k-medoids++ seedings in parallel and keep the best result.
+    # The sampling engines never build the distance matrix of all flowers, a fixed seed keeps them reproducible
+    # unless random medoids are requested
+    seed = None if random_medoids else 0
+    costs = None
+    if algorithm == 'CLARA':
+        new_medoids, new_cost = clara(features, k, METRIC, random_state=seed, progress=report_progress, stop=stop)
+    elif algorithm == 'CLARANS':
+        new_medoids, new_cost = clarans(features, k, METRIC, random_state=seed, progress=report_progress, stop=stop)
+    elif random_medoids:
+        new_medoids, new_cost, costs = multi_start(distances, k, N_STARTS, workers=N_WORKERS,
+                                                   progress=report_progress, stop=stop)
     else:
-        indexes = np.random.randint(0, len(data)-1, k)
-        medoids = [m for m in indexes]
-
-    # calculation cost
-    original_cost = get_cost(medoids)
-
-    new_cost = original_cost
-    old_cost = original_cost
-    smaller = True
-
-    # calc best medoids
-    best_combo = (None, None)
-    new_medoids = [m for m in medoids]
-
-    while smaller:
-        for m in range(0, k):
-            for p in data.index:
-                if new_medoids[m] == p:
-                    continue
-                tmp = new_medoids[m]
-                new_medoids[m] = p
-                new_cost = get_cost(new_medoids)
-                if new_cost < old_cost:
-                    old_cost = new_cost
-                    best_combo = (m, p)
-                new_medoids[m] = tmp
-        if not best_combo == (None, None):
-            new_medoids[best_combo[0]] = best_combo[1]
-            new_cost = get_cost(new_medoids)
-            best_combo = (None, None)
-        else:
-            new_cost = old_cost
-            smaller = False
-
-    # setting colors of clusters
-    for p in data.index:
-        curr_d = []
-        for m in new_medoids:
-            dist = get_distance(p, m)
-            curr_d.append(dist)
-        if min(curr_d) == curr_d[0]:
-            color[p] = 'red'
-        elif min(curr_d) == curr_d[1]:
-            color[p] = 'green'
-        else:
-            color[p] = 'blue'
-
-    source.data['Color'] = color
+        medoids = [24, 74, 124] if k == 3 else kmedoids_plus_plus(distances, k, random_state=0)
+        new_medoids, new_cost = faster_pam(distances, medoids, progress=report_progress, stop=stop)
+
+    return new_medoids, new_cost, costs
 
+
+def report_progress(medoids, cost):
+    # Called by the engines in the executor thread with every improved set of medoids
+    labels = nearest_medoids(features, medoids, METRIC)[0]
+    doc.add_next_tick_callback(partial(show_clusters, labels, 'The current cost is: {:.2f}'.format(cost)))
+
+
+def finish_clustering(result):
+    button.disabled = False
+    cancel_button.disabled = True
+    if result is None:
+        div.text = 'The clustering failed'
+        return
+
+    new_medoids, new_cost, costs = result
     # changing costs in div
-    div.text = 'The final cost is: {:.2f}'.format(new_cost)
+    text = 'The final cost is: {:.2f}'.format(new_cost)
+    if stop.is_set():
+        text += ' (cancelled)'
+    if costs is not None:
+        text += '<br>Best of {} starts, costs from {:.2f} to {:.2f} (median {:.2f})'.format(
+            len(costs), costs.min(), costs.max(), np.median(costs))
+    show_clusters(nearest_medoids(features, new_medoids, METRIC)[0], text)
+
+
+def show_clusters(labels, text):
+    # setting colors of clusters, only the flowers whose cluster changed are sent to the browser
+    new_color = CLUSTER_COLORS[labels]
+    changed = np.flatnonzero(new_color != np.asarray(source.data['Color']))
+    if len(changed):
+        source.patch(dict(Color=[(int(p), new_color[p]) for p in changed]))
+    div.text = text
 
 
 # read and store the dataset
@@ -93,6 +111,32 @@ sepal_width = np.array(data['sepal_width'])
 petal_length = np.array(data['petal_length'])
 petal_width = np.array(data['petal_width'])
 
+# Number of clusters, the distance between flowers (one of kmedoids.METRICS) and whether the features are standardized
+# before the clustering
+K = 3
+METRIC = 'l1'
+STANDARDIZE = False
+
+# The clustering works on one contiguous n x d float32 array of all numeric columns, which can be any dataset read with
+# kmedoids.load_features. The distances between all flowers are computed once, so that the cost of a set of medoids is
+# a single min reduction
+features = prepare_features(data, standardize=STANDARDIZE)
+distances = pairwise_distances(features, METRIC)
+# Colors of the clusters, repeated for more than ten clusters, gray stays the color of unclustered flowers
+CLUSTER_COLORS = np.resize(['red', 'green', 'blue', 'orange', 'purple', 'brown', 'pink', 'olive', 'cyan', 'black'], K)
+
+# Number of restarts with random medoids and the number of processes they run on, None uses one per CPU core. Datasets
+# smaller than kmedoids.MIN_PARALLEL_POINTS, like the iris flowers, are clustered in the server process.
+N_STARTS = 8
+N_WORKERS = None
+
+# The clustering of this session runs in a background thread, which the cancel button asks to stop early. The
+# document is kept since curdoc() is not available in that thread.
+doc = curdoc()
+executor = ThreadPoolExecutor(max_workers=1)
+stop = threading.Event()
+doc.on_session_destroyed(close_session)
+
 # create a color column in your dataframe and set it to gray on startup
 data['color'] = 'gray'
 color = np.array(data['color'])
@@ -121,12 +165,16 @@ p2.sizing_mode = 'stretch_both'
 
 # Create a select widget, a button, a DIV to show the final clustering cost and two figures for the scatter plots.
 data_select = Select(title='Random Medoids', value='False', options=['False', 'True'])
+# PAM is exact, CLARA runs it on samples and CLARANS tries random swaps, both for datasets too large for a distance matrix
+algorithm_select = Select(title='Algorithm', value='PAM', options=['PAM', 'CLARA', 'CLARANS'])
 button = Button(label='Cluster data', button_type='success')
 button.on_click(k_medoids)
+cancel_button = Button(label='Cancel', button_type='danger', disabled=True)
+cancel_button.on_click(cancel_clustering)
 div = Div(text="The final cost is: ")
 
 # use curdoc to add your widgets to the document
-curdoc().add_root(row(column(data_select, button, div), p1, p2))
+curdoc().add_root(row(column(data_select, algorithm_select, button, cancel_button, div), p1, p2))
 curdoc().title = "DVA_ex_3"
 
 
@@ -0,0 +1,422 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+
+from worker_processes import process_context
+
+# Selectable distances between points and the names scipy's cdist knows them by
+METRICS = dict(l1='cityblock', l2='euclidean', cosine='cosine')
+
+
+def prepare_features(frame, columns=None, standardize=False) -> np.ndarray:
+    """
+    Converts the numeric columns of a frame to the feature array of the engines.
+
+    :param frame: A DataFrame, or a 2D array of points
+    :param columns: Names of the feature columns, if None all numeric columns of the frame are used
+    :param standardize: If True every feature is shifted and scaled to mean 0 and standard deviation 1, so that features
+        with large values do not dominate the distances
+    :return: An n x d C-contiguous float32 array
+    """
+    if isinstance(frame, pd.DataFrame):
+        frame = frame[columns] if columns is not None else frame.select_dtypes('number')
+    features = np.asarray(frame, dtype=np.float64)
+    if features.ndim != 2:
+        raise ValueError('expected a 2D array of points, got shape {}'.format(features.shape))
+
+    if standardize:
+        std = features.std(axis=0)
+        features = (features - features.mean(axis=0)) / np.where(std > 0, std, 1.0)
+    return np.ascontiguousarray(features, dtype=np.float32)
+
+
+def load_features(csv_path, columns=None, standardize=False) -> np.ndarray:
+    """
+    Reads the feature array from a CSV file with a header row.
+
+    :param csv_path: Path of the CSV file
+    :param columns: Names of the feature columns, if None all numeric columns are used
+    :param standardize: If True every feature is standardized, see prepare_features
+    :return: An n x d C-contiguous float32 array
+    """
+    return prepare_features(pd.read_csv(csv_path, usecols=columns), columns, standardize)
+
+
+def _check_metric(metric) -> str:
+    # The cdist name of a metric
+    if metric not in METRICS:
+        raise ValueError('unknown metric {!r}, expected one of {}'.format(metric, tuple(METRICS)))
+    return METRICS[metric]
+
+
+def pairwise_distances(features, metric='l1', block_size=1024, dtype=np.float32) -> np.ndarray:
+    """
+    Computes the distances between all pairs of points, block by block of rows, so that only a block_size x n float64
+    temporary array is held in memory next to the result.
+
+    :param features: An n x d array of points
+    :param metric: One of METRICS
+    :param block_size: Number of rows computed at a time
+    :param dtype: Data type of the distance matrix, float32 halves the memory of large n
+    :return: An n x n array of distances
+    """
+    metric = _check_metric(metric)
+    features = np.asarray(features, dtype=np.float64)
+    n = len(features)
+    distances = np.empty((n, n), dtype=dtype)
+    for start in range(0, n, block_size):
+        distances[start:start + block_size] = cdist(features[start:start + block_size], features, metric)
+    return distances
+
+
+def total_cost(distances, medoids) -> float:
+    """
+    Sum of the distances of all points to their closest medoid.
+
+    :param distances: An n x n distance matrix
+    :param medoids: Indices of the medoids
+    :return: The cost of the clustering
+    """
+    return float(distances[list(medoids)].min(axis=0).sum(dtype=np.float64))
+
+
+def assign_labels(distances, medoids) -> np.ndarray:
+    """
+    Assigns every point to its closest medoid, ties go to the medoid that comes first.
+
+    :param distances: An n x n distance matrix
+    :param medoids: Indices of the medoids
+    :return: An n array with the position of the closest medoid in medoids
+    """
+    return distances[list(medoids)].argmin(axis=0)
+
+
+def faster_pam(distances, medoids, eager=True, max_sweeps=100, progress=None, stop=None) -> tuple:
+    """
+    Improves the medoids with the FasterPAM swap search. The distances of every point to its nearest and second nearest
+    medoid are cached, which makes the change of the cost of all k swaps with one candidate point an O(n) update.
+
+    :param distances: An n x n distance matrix, only single rows and the rows of the medoids are accessed
+    :param medoids: Indices of the k initial medoids, any k < n
+    :param eager: If True the best swap with a candidate is applied as soon as it improves the cost, otherwise only the
+        best swap of a whole pass over the candidates is applied, like the original PAM does
+    :param max_sweeps: Maximal number of passes over all candidate points
+    :param progress: A function that is called with a copy of the medoids and their cost after every applied swap
+    :param stop: A threading.Event that ends the search with the current medoids when it is set
+    :return: A tuple of the medoid indices and the final cost
+    """
+    medoids = np.array(medoids, dtype=np.intp)
+    n = len(distances)
+    medoid_rows = np.array(distances[medoids])
+    cache = _SwapCache(medoid_rows)
+
+    def apply_swap(removed, candidate, row):
+        medoids[removed] = candidate
+        medoid_rows[removed] = row
+        swapped = _SwapCache(medoid_rows)
+        if progress is not None:
+            progress(medoids.copy(), swapped.cost)
+        return swapped
+
+    for sweep in range(max_sweeps):
+        best_swap = None
+        for candidate in range(n):
+            if _stopped(stop):
+                return medoids, cache.cost
+            if candidate in medoids:
+                continue
+
+            row = np.asarray(distances[candidate])
+            delta = cache.swap_deltas(row)
+            removed = int(np.argmin(delta))
+            if delta[removed] >= -cache.tolerance:
+                continue
+            if eager:
+                cache = apply_swap(removed, candidate, row)
+                best_swap = ()
+            elif best_swap is None or delta[removed] < best_swap[0]:
+                best_swap = (delta[removed], removed, candidate, row)
+
+        # the search stops after a pass over all candidates without an improving swap
+        if best_swap is None:
+            break
+        if not eager:
+            cache = apply_swap(*best_swap[1:])
+
+    return medoids, cache.cost
+
+
+def _stopped(stop) -> bool:
+    # Whether the caller asked a search to end early
+    return stop is not None and stop.is_set()
+
+
+class _SwapCache:
+    """
+    Distances of every point to its nearest and second nearest medoid, and the loss of removing each medoid.
+
+    :param medoid_rows: A k x n array with the distances of the medoids to all points
+    """
+
+    def __init__(self, medoid_rows):
+        self.k = len(medoid_rows)
+        self.nearest = medoid_rows.argmin(axis=0)
+        if self.k > 1:
+            two = np.partition(medoid_rows, 1, axis=0)
+            self.d_nearest, self.d_second = two[0], two[1]
+        else:
+            self.d_nearest, self.d_second = medoid_rows[0], np.full(medoid_rows.shape[1], np.inf)
+        self.cost = float(self.d_nearest.sum(dtype=np.float64))
+        # the cost changes are computed in the precision of the distances, smaller changes are rounding errors and
+        # accepting them could swap back and forth forever
+        self.tolerance = 4 * np.finfo(medoid_rows.dtype).eps * max(1.0, self.cost)
+        # removing a medoid moves its points to their second nearest medoid
+        self.removal_loss = np.bincount(self.nearest, self.d_second - self.d_nearest, minlength=self.k)
+
+    def swap_deltas(self, row) -> np.ndarray:
+        """
+        Change of the cost of replacing each medoid with a candidate.
+
+        :param row: Distances of the candidate to all points
+        :return: A k array of cost changes, negative values are improvements
+        """
+        if self.k == 1:
+            return np.array([row.sum(dtype=np.float64) - self.cost])
+        # points closer to the candidate than to their nearest medoid move to it whichever medoid is removed, points
+        # between their nearest and second nearest medoid only move to it if their nearest medoid is removed
+        gain = np.minimum(row - self.d_nearest, 0)
+        loss = np.where(row < self.d_second, np.maximum(row, self.d_nearest) - self.d_second, 0)
+        return self.removal_loss + np.bincount(self.nearest, loss, minlength=self.k) + gain.sum(dtype=np.float64)
+
+
+def nearest_medoids(features, medoids, metric='l1', block_size=65536) -> tuple:
+    """
+    Assigns every point to its closest medoid without a distance matrix, block by block of points.
+
+    :param features: An n x d array of points
+    :param medoids: Indices of the medoids
+    :param metric: One of METRICS
+    :param block_size: Number of points assigned at a time
+    :return: A tuple of an n array with the position of the closest medoid in medoids and an n array of the distances
+        to it
+    """
+    metric = _check_metric(metric)
+    features = np.asarray(features, dtype=np.float64)
+    centers = features[list(medoids)]
+    labels = np.empty(len(features), dtype=np.intp)
+    nearest = np.empty(len(features))
+    for start in range(0, len(features), block_size):
+        block = cdist(features[start:start + block_size], centers, metric)
+        labels[start:start + block_size] = block.argmin(axis=1)
+        nearest[start:start + block_size] = block.min(axis=1)
+    return labels, nearest
+
+
+def clara(features, k, metric='l1', n_samples=5, sample_size=None, random_state=None, progress=None,
+          stop=None) -> tuple:
+    """
+    CLARA: runs the swap search on the distance matrices of random samples and keeps the medoids with the lowest cost
+    on all points. Every sample contains the best medoids so far, so later samples can only improve them.
+
+    :param features: An n x d array of points
+    :param k: Number of medoids
+    :param metric: One of METRICS
+    :param n_samples: Number of samples
+    :param sample_size: Number of points per sample, if None 100 + 5 * k
+    :param random_state: Seed of the samples
+    :param progress: A function that is called with a copy of the medoids and their cost whenever a sample improved them
+    :param stop: A threading.Event that ends the search with the best medoids so far when it is set
+    :return: A tuple of the medoid indices and the cost on all points
+    """
+    features = np.asarray(features)
+    n = len(features)
+    sample_size = min(n, sample_size or 100 + 5 * k)
+    rng = np.random.default_rng(random_state)
+
+    best_medoids, best_cost = None, np.inf
+    for _ in range(n_samples):
+        if _stopped(stop) and best_medoids is not None:
+            break
+        sample = rng.choice(n, sample_size, replace=False)
+        if best_medoids is not None:
+            # the random order of the sample is kept, so that truncating it drops random points rather than the
+            # highest indices
+            sample = np.concatenate([best_medoids, sample[~np.isin(sample, best_medoids)][:sample_size - k]])
+        sample_medoids, _ = faster_pam(pairwise_distances(features[sample], metric), np.arange(k), stop=stop)
+        medoids = sample[sample_medoids]
+        cost = float(nearest_medoids(features, medoids, metric)[1].sum())
+        if cost < best_cost:
+            best_medoids, best_cost = medoids, cost
+            if progress is not None:
+                progress(medoids.copy(), cost)
+
+    return best_medoids, best_cost
+
+
+def clarans(features, k, metric='l1', n_local=2, max_neighbors=None, random_state=None, progress=None,
+            stop=None) -> tuple:
+    """
+    CLARANS: a randomized swap search on all points. From random medoids, random swaps are tried and applied if they
+    improve the cost until max_neighbors swaps in a row did not, and the best of n_local such searches is kept. The
+    distances of a swap candidate are computed when it is tried, so no distance matrix is needed.
+
+    :param features: An n x d array of points
+    :param k: Number of medoids
+    :param metric: One of METRICS
+    :param n_local: Number of searches
+    :param max_neighbors: Number of failed swaps that end a search, if None 1.25% of the k * (n - k) possible swaps but
+        at least 250
+    :param random_state: Seed of the medoids and swaps
+    :param progress: A function that is called with a copy of the medoids and their cost after every applied swap that
+        improves on the best medoids so far
+    :param stop: A threading.Event that ends the search with the best medoids so far when it is set
+    :return: A tuple of the medoid indices and the cost on all points
+    """
+    metric = _check_metric(metric)
+    features = np.asarray(features, dtype=np.float64)
+    n = len(features)
+    max_neighbors = max_neighbors or max(250, int(0.0125 * k * (n - k)))
+    rng = np.random.default_rng(random_state)
+
+    def row(idx):
+        return cdist(features[idx:idx + 1], features, metric)[0]
+
+    best_medoids, best_cost = None, np.inf
+    for _ in range(n_local):
+        if _stopped(stop) and best_medoids is not None:
+            break
+        medoids = rng.choice(n, k, replace=False)
+        medoid_rows = np.stack([row(m) for m in medoids])
+        cache = _SwapCache(medoid_rows)
+        failures = 0
+        while failures < max_neighbors and not _stopped(stop):
+            removed, candidate = rng.integers(k), rng.integers(n)
+            if candidate in medoids:
+                continue
+            candidate_row = row(candidate)
+            if cache.swap_deltas(candidate_row)[removed] < -cache.tolerance:
+                medoids[removed] = candidate
+                medoid_rows[removed] = candidate_row
+                cache = _SwapCache(medoid_rows)
+                failures = 0
+                if progress is not None and cache.cost < best_cost:
+                    progress(medoids.copy(), cache.cost)
+            else:
+                failures += 1
+        if cache.cost < best_cost:
+            best_medoids, best_cost = medoids.copy(), cache.cost
+
+    return best_medoids, best_cost
+
+
+def kmedoids_plus_plus(distances, k, random_state=None) -> np.ndarray:
+    """
+    k-medoids++ seeding: the first medoid is a random point and every further one is drawn with a probability
+    proportional to the distance to its closest medoid so far, which spreads the medoids over the data and never picks
+    a point twice.
+
+    :param distances: An n x n distance matrix, only the rows of the medoids are accessed
+    :param k: Number of medoids
+    :param random_state: Seed of the draws
+    :return: An array of k distinct medoid indices
+    """
+    rng = np.random.default_rng(random_state)
+    n = len(distances)
+    medoids = [int(rng.integers(n))]
+    closest = np.asarray(distances[medoids[0]], dtype=np.float64).copy()
+    for _ in range(1, k):
+        weights = closest.copy()
+        weights[medoids] = 0
+        if weights.sum() > 0:
+            medoid = int(rng.choice(n, p=weights / weights.sum()))
+        else:
+            # all remaining points coincide with a medoid
+            medoid = int(rng.choice(np.setdiff1d(np.arange(n), medoids)))
+        medoids.append(medoid)
+        np.minimum(closest, distances[medoid], out=closest)
+    return np.array(medoids, dtype=np.intp)
+
+
+# Starting the worker processes takes about a second, the restarts of smaller datasets run faster in this process
+MIN_PARALLEL_POINTS = 3000
+
+
+# Distance matrix of a worker process, a view on the shared memory block of the parent process
+_worker_distances = {}
+
+
+def _attach_shared_distances(name, shape, dtype):
+    # Runs once per worker process. The SharedMemory object is kept alive as long as the worker, otherwise the view
+    # would point to unmapped memory.
+    shm = shared_memory.SharedMemory(name=name)
+    _worker_distances['matrix'] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _run_start(distances, k, seed, stop=None):
+    medoids, cost = faster_pam(distances, kmedoids_plus_plus(distances, k, seed), stop=stop)
+    return medoids, cost
+
+
+def _run_shared_start(task):
+    return _run_start(_worker_distances['matrix'][1], *task)
+
+
+def multi_start(distances, k, n_starts=8, workers=None, random_state=None, progress=None, stop=None) -> tuple:
+    """
+    Runs the swap search from n_starts k-medoids++ seedings spread across a pool of worker processes and keeps the best
+    result.
+
+    :param distances: An n x n distance matrix
+    :param k: Number of medoids
+    :param n_starts: Number of restarts
+    :param workers: Number of worker processes, if None one per CPU core is used. With 1 or fewer than
+        MIN_PARALLEL_POINTS points the restarts run in this process.
+    :param random_state: Seed from which the seeds of the restarts are derived
+    :param progress: A function that is called with a copy of the medoids and their cost whenever a finished restart
+        improved on the best result so far
+    :param stop: A threading.Event that cancels the restarts that did not start yet when it is set, the running ones
+        still finish
+    :return: A tuple of the best medoid indices, their cost and an array with the final cost of every restart
+    """
+    seeds = [seed.generate_state(1)[0] for seed in np.random.SeedSequence(random_state).spawn(n_starts)]
+    workers = min(workers or os.cpu_count() or 1, n_starts) if len(distances) >= MIN_PARALLEL_POINTS else 1
+
+    results = []
+
+    def collect(result):
+        if progress is not None and (not results or result[1] < min(cost for _, cost in results)):
+            progress(result[0].copy(), result[1])
+        results.append(result)
+
+    if workers <= 1:
+        for seed in seeds:
+            if _stopped(stop) and results:
+                break
+            collect(_run_start(distances, k, seed, stop))
+    else:
+        # The workers read the distance matrix from shared memory, so it is neither pickled nor copied per worker
+        distances = np.asarray(distances)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, distances.nbytes))
+        try:
+            np.ndarray(distances.shape, dtype=distances.dtype, buffer=shm.buf)[...] = distances
+            with ProcessPoolExecutor(max_workers=workers, mp_context=process_context(),
+                                     initializer=_attach_shared_distances,
+                                     initargs=(shm.name, distances.shape, distances.dtype)) as executor:
+                futures = [executor.submit(_run_shared_start, (k, seed)) for seed in seeds]
+                for future in as_completed(futures):
+                    if _stopped(stop):
+                        for pending in futures:
+                            pending.cancel()
+                    if not future.cancelled():
+                        collect(future.result())
+        finally:
+            shm.close()
+            shm.unlink()
+
+    costs = np.array([cost for _, cost in results])
+    best = int(costs.argmin())
+    return results[best][0], costs[best], costs
@@ -0,0 +1,22 @@
+import multiprocessing
+import os
+import sys
+
+# The process pools are created from threads of the bokeh server, and forking a process with running threads can
+# deadlock the children on locks held by the other threads. The workers are started from a clean server process
+# instead, or spawned where that is not available.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def process_context():
+    """
+    Multiprocessing context of all process pools of the exercise, for the mp_context of a ProcessPoolExecutor.
+
+    :return: A context that starts the workers with START_METHOD
+    """
+    # Started workers import the modules of this directory to unpickle their functions, but bokeh serve only puts the
+    # directory of the app on the path while the app script runs
+    if _MODULE_DIR not in sys.path:
+        sys.path.append(_MODULE_DIR)
+    return multiprocessing.get_context(START_METHOD)
@@ -7,7 +7,9 @@ from bokeh.plotting import figure, output_file, show
 from bokeh.models import ColorBar, LinearColorMapper, BasicTicker
 from colorcet import CET_L16
 
-from colorsys import hsv_to_rgb
+from wind_volume import WindVolume
+import wind_fields
+from wind_derivatives import divergence_vorticity
 
 
 # scale values for colors not normalize it!!
@@ -27,74 +29,53 @@ def to_bokeh_image(rgba_uint8):
     return [np_img2d]
 
 def get_divergence(vx_wind, vy_wind):
-    # Use np.gradient to calculate the gradient of a vector field. Find out what exactly the return values represent and
-    # use the appropriate elements for your calculations
-
-    div_v = 0
-        # your code
-    n_vx = len(vx_wind)
-    n_vy = len(vy_wind)
-    np.ufunc.reduce(np.add, [np.gradient(f[i], axis=i) for i in range(num_dims)])
-
-    return div_v
+    # np.gradient returns the derivatives along every axis of the array, axis 0 along the rows and axis 1 along the
+    # columns. The divergence is the sum of the derivatives of the components with respect to their own axis.
+    return divergence_vorticity(vx_wind, vy_wind)[0]
 
 def get_vorticity(vx_wind, vy_wind):
-    # Calculate the gradient again and use the appropriate results to calculate the vorticity. Think about what happens
-    # to the z-component and the derivatives with respect to z for a two dimensional vector field.
-    # (You can save the gradient in the divergence calculations or recalculate it here. Since the gradient function is
-    # fast and we have rather small data slices the impact of recalculating it is negligible.)
-
-    vort_v = 0
-        # your code
-
-    return vort_v
+    # For a two dimensional vector field the z-component of the vectors and all derivatives with respect to z are 0, so
+    # only the z-component of the vorticity remains. The gradients are shared with the divergence when both are
+    # needed, see divergence_vorticity.
+    return divergence_vorticity(vx_wind, vy_wind)[1]
 
 # Calculates the HSV colors of the xy-windspeed vectors and maps them to RGBA colors
 def vector_color_coding(vx_wind, vy_wind):
-    # Calculate the hue (H) as the angle between the vector and the positive x-axis
-        # your code
-
-    # Saturation (S) can be set to 1
-    S = 1
-
-    # The brightness value (V) is set on the normalized magnitude of the vector
-
-    # Either use colorsys.hsv_to_rgb or implement the color conversion yourself using the
-    # algorithm for the HSV to RGB conversion, see https://www.rapidtables.com/convert/color/hsv-to-rgb.html
-    rgba_colors = np.array(0)
-        # your code
-
-    # The RGBA colors have to be saved as uint8 for the bokeh plot to properly work
-    return rgba_colors.astype('uint8')
+    # The hue (H) is the angle between the vector and the positive x-axis, the saturation (S) 1 and the brightness
+    # value (V) the normalized magnitude of the vector. The HSV to RGB conversion is vectorized and writes the uint8
+    # RGBA colors the bokeh plot needs directly, see wind_fields.hsv_to_rgba.
+    return wind_fields.vector_color_coding(vx_wind, vy_wind, value_range=vcc_value_range, lut=HSV_LUT)
 
 
 # Load and process the required data
 print('processing data')
-xWind_file = 'Uf24.bin'
-xWind_path = os.path.abspath(os.path.dirname(xWind_file))
-xWind_data = np.fromfile(os.path.join(xWind_path, xWind_file), dtype=np.dtype('>f'))
-xWind_data = np.reshape(xWind_data, [500, 500, 100], order='F')
-xWind_data = np.flipud(xWind_data)
+# The volumes are memory mapped and only the plotted altitude level is read, with the missing "no data" values replaced
+# by the average of the whole dataset. The statistics of a volume (valid count, mean, range and percentiles) are
+# computed in one pass over the file and cached next to it.
+LEVEL = 20
+xWind = WindVolume(os.path.join(os.path.abspath('.'), 'Uf24.bin'))
+xWind_data = xWind.level(LEVEL)
 
 print(xWind_data)
 
-# Replace the missing "no data" values with the average of the dataset
-filtered_average = np.average(xWind_data[xWind_data < 1e35])
-xWind_data[xWind_data == 1e35] = filtered_average
+yWind = WindVolume(os.path.join(os.path.abspath('.'), 'Vf24.bin'))
+yWind_data = yWind.level(LEVEL)
 
-yWind_file = 'Vf24.bin'
-yWind_path = os.path.abspath(os.path.dirname(yWind_file))
-yWind_data = np.fromfile(os.path.join(yWind_path, yWind_file), dtype=np.dtype('>f'))
-yWind_data = np.reshape(yWind_data, [500, 500, 100], order='F')
-yWind_data = np.flipud(yWind_data)
+# The wind speed plots span the range of the whole volume, a (low, high) pair of the percentiles in the volume
+# statistics (see wind_volume.PERCENTILES), e.g. (1, 99), leaves out the outliers instead
+COLOR_RANGE_PERCENTILES = None
 
-# Replace the missing "no data" values with the average of the dataset
-filtered_average = np.average(yWind_data[yWind_data < 1e35])
-yWind_data[yWind_data == 1e35] = filtered_average
+# Normalization of the vector magnitudes for the color coding (one of wind_fields.NORMALIZATIONS), 'global' makes the
+# brightness comparable between levels, its range is computed once over all levels and cached next to the x volume. A
+# wind_fields.HsvLut can replace the exact color conversion when many frames are converted.
+VALUE_NORMALIZATION = 'level'
+HSV_LUT = None
+vcc_value_range = wind_fields.magnitude_range(xWind, yWind) if VALUE_NORMALIZATION == 'global' else None
 
 wind_vcc = vector_color_coding(xWind_data, yWind_data)
-wind_divergence = get_divergence(xWind_data, yWind_data)
-wind_vorticity = get_vorticity(xWind_data, yWind_data)
+# the gradients of both components are computed once for the divergence and the vorticity, see wind_derivatives.py for
+# all levels of the volume at once
+wind_divergence, wind_vorticity = divergence_vorticity(xWind_data, yWind_data)
 print('data processing completed')
 
 
@@ -103,16 +84,18 @@ img_args = {'dh': 500, 'dw': 500, 'x': 0, 'y': 0}
 cb_args = {'ticker': BasicTicker(), 'label_standoff': 12, 'border_line_color': None, 'location': (0,0)}
 
 # Create x wind speed plot
-color_mapper_xWind = LinearColorMapper(palette=CET_L16, low=np.amin(xWind_data), high=np.amax(xWind_data))
+xWind_range = xWind.value_range(COLOR_RANGE_PERCENTILES)
+color_mapper_xWind = LinearColorMapper(palette=CET_L16, low=xWind_range[0], high=xWind_range[1])
 xWind_plot = figure(title="x-Wind speed (West - East)", **fig_args)
-xWind_plot.image(image=to_bokeh_image(xWind_data[:,:,20]), color_mapper=color_mapper_xWind, **img_args)
+xWind_plot.image(image=to_bokeh_image(xWind_data), color_mapper=color_mapper_xWind, **img_args)
 xWind_color_bar = ColorBar(color_mapper=color_mapper_xWind, **cb_args)
 xWind_plot.add_layout(xWind_color_bar, 'right')
 
 # Create y wind speed plot
-color_mapper_yWind = LinearColorMapper(palette=CET_L16, low=np.amin(yWind_data), high=np.amax(yWind_data))
+yWind_range = yWind.value_range(COLOR_RANGE_PERCENTILES)
+color_mapper_yWind = LinearColorMapper(palette=CET_L16, low=yWind_range[0], high=yWind_range[1])
 yWind_plot = figure(title="y-Wind speed South - North", **fig_args)
-yWind_plot.image(image=to_bokeh_image(yWind_data[:,:,20]), color_mapper=color_mapper_yWind, **img_args)
+yWind_plot.image(image=to_bokeh_image(yWind_data), color_mapper=color_mapper_yWind, **img_args)
 yWind_color_bar = ColorBar(color_mapper=color_mapper_yWind, **cb_args)
 yWind_plot.add_layout(yWind_color_bar, 'right')
 
@@ -1,17 +1,21 @@
+from functools import partial
+
 import numpy as np
 import os
 import bokeh
 
 
-from bokeh.layouts import layout, row
-from bokeh.plotting import figure, output_file, show
-from bokeh.models import ColorBar, LinearColorMapper, BasicTicker
+from bokeh.layouts import layout, row, column
+from bokeh.plotting import figure, output_file, show, curdoc
+from bokeh.models import ColorBar, LinearColorMapper, BasicTicker, ColumnDataSource, Slider
 from colorcet import CET_L16, __version__
 
 print(__version__)
-from colorsys import hsv_to_rgb
+from wind_volume import WindVolume
+from level_cache import shared_cache
+from wind_derivatives import divergence_vorticity
+import wind_fields
 
-output_file('DVA_ex4.html')
 color = CET_L16
 
 def to_bokeh_image(rgba_uint8):
@@ -29,121 +33,101 @@ def to_bokeh_image(rgba_uint8):
 def get_divergence(vx_wind, vy_wind):
     # np.gradient returns a set of arrays with the same shape as the input array. The number of returned arrays corres-
     # ponds to the number of dimensions of the input array. I.e. the gradient is calculated along all axes.
-    vx_grad = np.gradient(vx_wind[:,:,20])
-    vx_grad_test = np.gradient(vx_wind[:,:,20], axis=0)
-    print(vx_grad[0] == vx_grad_test)
-    vy_grad = np.gradient(vy_wind[:,:,20])
-
     # The divergence is the sum of the derivatives of all axis with respect to themselfs.
-    div_v = vx_grad[0] + vy_grad[1]
-    return  div_v
+    return divergence_vorticity(vx_wind, vy_wind)[0]
 
 def get_vorticity(vx_wind, vy_wind):
-    # np.gradient returns a set of arrays with the same shape as the input array. The number of returned arrays corres-
-    # ponds to the number of dimensions of the input array. I.e. the gradient is calculated along all axes.
-    vx_grad = np.gradient(vx_wind[:, :, 20])
-    vy_grad = np.gradient(vy_wind[:, :, 20])
-
     # vorticity the z-component is 0 and vx and vy are constant with respect to z, which leads to the first two compo-
     # nents of the vorticity being 0
-    vort_v = vy_grad[0] - vx_grad[1]
-
-    return  vort_v
+    return divergence_vorticity(vx_wind, vy_wind)[1]
 
 # calculates the HSV colors of the xy-windspeed vectors and maps them to RGBA colors
 def vector_color_coding(vx_wind, vy_wind):
-    # calculate the hue as the angle between the vector and the positive x-axis
-    rgba_colors = np.zeros((500, 500, 4))
-    y_coord = vy_wind[:, :, 20].flatten()
-    x_coord = vx_wind[:, :, 20].flatten()
-    hue = np.arctan2(y_coord, x_coord)
-    hue[hue < 0] = hue[hue < 0] + 2 * np.pi
-    hue = np.reshape(hue, (500, 500))
-    hue = hue * 180 / np.pi
-
-    # Saturation (S) can be set to 1
-    S = 1
-
-    impl = 0
-    if impl == 0:
-        # The brightness value (V) is set on the normalized magnitude of the vector
-        # Calculate a matrix of all vector norms
-        print('Fast V implementation')
-        vxy_wind = np.concatenate((vx_wind[:, :, 20][..., np.newaxis], vy_wind[:, :, 20][..., np.newaxis]), axis=2)
-        V_norm = np.linalg.norm(vxy_wind, axis=2)
-        n_max = np.amax(V_norm)
-        n_min = np.amin(V_norm)
-        V = (V_norm - n_min) / (n_max - n_min)
-    elif impl == 1:
-        # alt implementation
-        print('alt V implementation')
-        vx_sq = np.square(vx_wind[:, :, 20])
-        vy_sq = np.square(vy_wind[:, :, 20])
-        vxy_sum = vx_sq + vy_sq
-        sum_root = np.sqrt(vxy_sum)
-        n_max = np.amax(sum_root)
-        n_min = np.amin(sum_root)
-        V = (sum_root - n_min) / (n_max - n_min)
+    # The hue is the angle between the vector and the positive x-axis, the saturation 1 and the brightness value the
+    # normalized magnitude of the vector. The HSV to RGB conversion is vectorized and writes the uint8 RGBA colors the
+    # bokeh plot needs directly, it gives the colors of colorsys.hsv_to_rgb within one step, see
+    # wind_fields.hsv_to_rgba.
+    return wind_fields.vector_color_coding(vx_wind, vy_wind, value_range=vcc_value_range, lut=HSV_LUT)
+
+
+def level_fields(level) -> dict:
+    # Everything the plots show of one altitude level, already in the form of the bokeh images. Runs in the threads of
+    # the level cache.
+    vx_wind = xWind.level(level)
+    vy_wind = yWind.level(level)
+    # both fields share the gradients of the components, see wind_derivatives.py for all levels of the volume at once
+    divergence, vorticity = divergence_vorticity(vx_wind, vy_wind)
+    return dict(xWind=to_bokeh_image(vx_wind), yWind=to_bokeh_image(vy_wind),
+                divergence=to_bokeh_image(divergence), divergence_range=(np.amin(divergence), np.amax(divergence)),
+                vorticity=to_bokeh_image(vorticity), vorticity_range=(np.amin(vorticity), np.amax(vorticity)),
+                vcc=to_bokeh_image(vector_color_coding(vx_wind, vy_wind)))
+
+def neighbour_levels(level):
+    # The levels around the selected one, nearest first, which the slider most likely reaches next
+    levels = []
+    for distance in range(1, PREFETCH_RADIUS + 1):
+        levels += [l for l in (level + distance, level - distance) if 0 <= l < xWind.n_levels]
+    return levels
+
+def change_level(attr, old, new):
+    # Cached levels are shown right away, the others are computed in a thread of the cache so that the server stays
+    # responsive while the slider is moved. A load replaces the one of this session that did not start yet, so that
+    # only the level the slider stops at is computed.
+    fields = level_cache.peek(new)
+    if fields is not None:
+        show_level(new, fields)
     else:
-        print('constant V=1 implementation')
-        V=np.ones((500,500))
+        level_cache.load(new, channel=doc).add_done_callback(partial(level_loaded, new))
 
+def prefetch_levels(attr, old, new):
+    # only once the slider is released, the levels passed while it is dragged are not worth computing ahead
+    level_cache.prefetch(neighbour_levels(new))
 
-    # Algorithm for the HSV to RGB conversion see https://www.rapidtables.com/convert/color/hsv-to-rgb.html
-    C = V * S
-    m = V - C
-    X = C * (1 - np.abs(np.mod(hue/60, 2) - 1))
+def level_loaded(level, future):
+    # Runs in the thread of the cache, the document is only changed in a next tick callback
+    if not future.cancelled() and future.exception() is None:
+        doc.add_next_tick_callback(partial(show_level, level, future.result()))
 
-    for i in range(500):
-        for j in range(500):
-            # Either use hsv_to_rgb
-            rgba_colors[i, j] = 255 * np.array([*hsv_to_rgb(hue[i, j] / 360.0, S, V[i, j]), 1.0])
-
-            # Or your own implementation
-
-            # if hue[i, j] < 60:
-            #     rgba_colors[i, j] = 255 * np.array([C[i, j] + m[i, j], X[i, j] + m[i, j], 0 + m[i, j], 1])
-            # elif hue[i, j] < 120:
-            #     rgba_colors[i, j] = 255 * np.array([X[i, j] + m[i, j], C[i, j] + m[i, j], 0 + m[i, j], 1])
-            # elif hue[i, j] < 180:
-            #     rgba_colors[i, j] = 255 * np.array([0 + m[i, j], C[i, j] + m[i, j], X[i, j] + m[i, j], 1])
-            # elif hue[i, j] < 240:
-            #     rgba_colors[i, j] = 255 * np.array([0 + m[i, j], X[i, j] + m[i, j], C[i, j] + m[i, j], 1])
-            # elif hue[i, j] < 300:
-            #     rgba_colors[i, j] = 255 * np.array([X[i, j] + m[i, j], 0 + m[i, j], C[i, j] + m[i, j], 1])
-            # else:
-            #     rgba_colors[i, j] = 255 * np.array([C[i, j] + m[i, j], 0 + m[i, j], X[i, j] + m[i, j], 1])
-
-    # The RGBA colors have to be saved as uint8 for the bokeh plot to properly work
-    return rgba_colors
+def show_level(level, fields):
+    # The images of the existing plots are replaced in place, a level that was computed after the slider moved on is
+    # not shown anymore
+    if level != level_slider.value:
+        return
+    for name, source in image_sources.items():
+        source.data['image'] = fields[name]
+    color_mapper_divergence.update(low=fields['divergence_range'][0], high=fields['divergence_range'][1])
+    color_mapper_vorticity.update(low=fields['vorticity_range'][0], high=fields['vorticity_range'][1])
 
 
 # load and process the required data
 print('processing data')
-xWind_file = 'Uf24.bin'
-xWind_path = os.path.abspath(os.path.dirname(xWind_file))
-xWind_data = np.fromfile(os.path.join(xWind_path, xWind_file), dtype=np.dtype('>f'))
-xWind_data = np.reshape(xWind_data, [500, 500, 100], order='F')
-xWind_data = np.flipud(xWind_data)
-
-# replace the missing "no data" values with the average of the dataset
-filtered_average = np.average(xWind_data[xWind_data < 1e35])
-xWind_data[xWind_data == 1e35] = filtered_average
-
-yWind_file = 'Vf24.bin'
-yWind_path = os.path.abspath(os.path.dirname(yWind_file))
-yWind_data = np.fromfile(os.path.join(yWind_path, yWind_file), dtype=np.dtype('>f'))
-yWind_data = np.reshape(yWind_data, [500, 500, 100], order='F')
-yWind_data = np.flipud(yWind_data)
-
-# replace the missing "no data" values with the average of the dataset
-filtered_average = np.average(yWind_data[yWind_data < 1e35])
-yWind_data[yWind_data == 1e35] = filtered_average
-
-wind_vcc = vector_color_coding(xWind_data, yWind_data)
-print(np.shape(wind_vcc))
-wind_divergence = get_divergence(xWind_data, yWind_data)
-wind_vorticity = get_vorticity(xWind_data, yWind_data)
+# The volumes are memory mapped and only the plotted altitude level is read, with the missing "no data" values replaced
+# by the average of the whole dataset. The statistics of a volume (valid count, mean, range and percentiles) are
+# computed in one pass over the file and cached next to it.
+LEVEL = 20
+xWind = WindVolume(os.path.join(os.path.abspath('.'), 'Uf24.bin'))
+yWind = WindVolume(os.path.join(os.path.abspath('.'), 'Vf24.bin'))
+
+# The wind speed plots span the range of the whole volume, a (low, high) pair of the percentiles in the volume
+# statistics (see wind_volume.PERCENTILES), e.g. (1, 99), leaves out the outliers instead
+COLOR_RANGE_PERCENTILES = None
+
+# Normalization of the vector magnitudes for the color coding (one of wind_fields.NORMALIZATIONS), 'global' makes the
+# brightness comparable between levels, its range is computed once over all levels and cached next to the x volume. A
+# wind_fields.HsvLut can replace the exact color conversion when many frames are converted.
+VALUE_NORMALIZATION = 'level'
+HSV_LUT = None
+vcc_value_range = wind_fields.magnitude_range(xWind, yWind) if VALUE_NORMALIZATION == 'global' else None
+
+# The derived fields of the levels are computed on demand and the most recently used CACHE_LEVELS of them are kept,
+# about 5 MB per level. In the server mode the PREFETCH_RADIUS levels above and below the selected one are computed
+# in the background, and all sessions share one cache since bokeh serve runs this script for every session.
+CACHE_LEVELS = 24
+PREFETCH_RADIUS = 3
+level_cache = shared_cache((xWind.path, yWind.path, VALUE_NORMALIZATION, HSV_LUT is None), level_fields,
+                           max_levels=CACHE_LEVELS)
+
+fields = level_cache.get(LEVEL)
 print('data processing completed')
 
 
@@ -151,38 +135,66 @@ fig_args = {'x_range': (0,500), 'y_range': (0,500), 'width': 500, 'height': 400,
 img_args = {'dh': 500, 'dw': 500, 'x': 0, 'y': 0}
 cb_args = {'ticker': BasicTicker(), 'label_standoff': 12, 'border_line_color': None, 'location': (0,0)}
 
+# one source per image, a change of the level only replaces their image column
+image_sources = {name: ColumnDataSource(data=dict(image=fields[name]))
+                 for name in ('xWind', 'yWind', 'divergence', 'vorticity', 'vcc')}
+
 # create x wind speed plot
-color_mapper_xWind = LinearColorMapper(palette=CET_L16, low=np.amin(xWind_data), high=np.amax(xWind_data))
+xWind_range = xWind.value_range(COLOR_RANGE_PERCENTILES)
+color_mapper_xWind = LinearColorMapper(palette=CET_L16, low=xWind_range[0], high=xWind_range[1])
 xWind_plot = figure(title="x-Wind speed (West - East)", **fig_args)
-xWind_plot.image(image=to_bokeh_image(xWind_data[:,:,20]), color_mapper=color_mapper_xWind, **img_args)
+xWind_plot.image(image='image', source=image_sources['xWind'], color_mapper=color_mapper_xWind, **img_args)
 xWind_color_bar = ColorBar(color_mapper=color_mapper_xWind, **cb_args)
 xWind_plot.add_layout(xWind_color_bar, 'right')
 
 # create y wind speed plot
-color_mapper_yWind = LinearColorMapper(palette=CET_L16, low=np.amin(yWind_data), high=np.amax(yWind_data))
+yWind_range = yWind.value_range(COLOR_RANGE_PERCENTILES)
+color_mapper_yWind = LinearColorMapper(palette=CET_L16, low=yWind_range[0], high=yWind_range[1])
 yWind_plot = figure(title="y-Wind speed South - North", **fig_args)
-yWind_plot.image(image=to_bokeh_image(yWind_data[:,:,20]), color_mapper=color_mapper_yWind, **img_args)
+yWind_plot.image(image='image', source=image_sources['yWind'], color_mapper=color_mapper_yWind, **img_args)
 yWind_color_bar = ColorBar(color_mapper=color_mapper_yWind, **cb_args)
 yWind_plot.add_layout(yWind_color_bar, 'right')
 
 # # create divergence plot
-color_mapper_divergence = LinearColorMapper(palette=CET_L16, low=np.amin(wind_divergence), high=np.amax(wind_divergence))
+color_mapper_divergence = LinearColorMapper(palette=CET_L16, low=fields['divergence_range'][0],
+                                            high=fields['divergence_range'][1])
 divergence_plot = figure(title="Divergence", **fig_args)
-divergence_plot.image(image=to_bokeh_image(wind_divergence), color_mapper=color_mapper_divergence, **img_args)
+divergence_plot.image(image='image', source=image_sources['divergence'], color_mapper=color_mapper_divergence,
+                      **img_args)
 divergence_color_bar = ColorBar(color_mapper=color_mapper_divergence, **cb_args)
 divergence_plot.add_layout(divergence_color_bar, 'right')
 
 # create vorticity plot
-color_mapper_vorticity = LinearColorMapper(palette=CET_L16, low=np.amin(wind_vorticity), high=np.amax(wind_vorticity))
+color_mapper_vorticity = LinearColorMapper(palette=CET_L16, low=fields['vorticity_range'][0],
+                                           high=fields['vorticity_range'][1])
 vorticity_plot = figure(title="Vorticity", **fig_args)
-vorticity_plot.image(image=to_bokeh_image(wind_vorticity), color_mapper=color_mapper_vorticity, **img_args)
+vorticity_plot.image(image='image', source=image_sources['vorticity'], color_mapper=color_mapper_vorticity,
+                     **img_args)
 vorticity_color_bar = ColorBar(color_mapper=color_mapper_vorticity, **cb_args)
 vorticity_plot.add_layout(vorticity_color_bar, 'right')
 
 # create vector color coding plot
 vcc_plot = figure(title="Vector Color Coding", **fig_args)
-vcc_plot.image_rgba(image=to_bokeh_image(wind_vcc), **img_args)
-
-# create and show plot layout
-final_layout = layout(row(xWind_plot, yWind_plot), row(divergence_plot, vorticity_plot, vcc_plot))# vcc_plot, vorticity_plot,
-show(final_layout)
+vcc_plot.image_rgba(image='image', source=image_sources['vcc'], **img_args)
+
+plots = layout(row(xWind_plot, yWind_plot), row(divergence_plot, vorticity_plot, vcc_plot))# vcc_plot, vorticity_plot,
+
+if __name__.startswith('bokeh_app_'):
+    # Run with bokeh serve, a slider selects the altitude level. The document is kept since curdoc() is not available
+    # in the threads of the cache.
+    doc = curdoc()
+    level_slider = Slider(title='Altitude level', start=0, end=xWind.n_levels - 1, value=LEVEL, step=1)
+    level_slider.on_change('value', change_level)
+    level_slider.on_change('value_throttled', prefetch_levels)
+    level_cache.prefetch(neighbour_levels(LEVEL))
+    doc.add_root(column(level_slider, plots))
+    doc.title = 'DVA_ex4'
+else:
+    # create and show plot layout of the level LEVEL
+    output_file('DVA_ex4.html')
+    show(plots)
+    level_cache.shutdown()
+
+# use one of the commands below to browse all levels
+# bokeh serve --show dva_ex4_sol_HS20.py
+# python -m bokeh serve --show dva_ex4_sol_HS20.py
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+import threading
+
+
+class LevelCache:
+    """
+    Bounded LRU cache of the fields derived from the altitude levels of a volume. Levels are computed on demand by the
+    calling thread or ahead of time by background threads, and every level is computed at most once while it is cached:
+    a request for a level whose computation is already running waits for it instead of starting a second one.
+
+    :param compute: Function that takes a level index and returns the derived fields of that level
+    :param max_levels: Number of levels that are kept, the least recently used ones are evicted first
+    :param workers: Number of threads that prefetch levels, a separate thread loads the levels requested with load
+    """
+
+    def __init__(self, compute, max_levels=24, workers=1):
+        if max_levels < 1:
+            raise ValueError('max_levels must be at least 1')
+        self.compute = compute
+        self.max_levels = max_levels
+        self._levels = OrderedDict()
+        self._pending = {}
+        self._loads = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._loader = ThreadPoolExecutor(max_workers=1)
+
+    def __contains__(self, level) -> bool:
+        with self._lock:
+            return level in self._levels
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._levels)
+
+    def peek(self, level):
+        """
+        Returns the fields of a level if they are cached, without computing them.
+
+        :param level: Index of the altitude level
+        :return: The cached fields or None
+        """
+        with self._lock:
+            if level in self._levels:
+                self._levels.move_to_end(level)
+                return self._levels[level]
+        return None
+
+    def get(self, level):
+        """
+        Returns the fields of a level, computing them in the calling thread if they are neither cached nor being
+        computed.
+
+        :param level: Index of the altitude level
+        :return: The fields of the level
+        """
+        with self._lock:
+            if level in self._levels:
+                self._levels.move_to_end(level)
+                return self._levels[level]
+            future = self._pending.get(level)
+            # a prefetch that did not start yet is taken over by the calling thread rather than waited for
+            owner = future is None or not future.running()
+            if owner:
+                if future is None:
+                    future = self._pending[level] = Future()
+                future.set_running_or_notify_cancel()
+
+        if owner:
+            self._run(level, future)
+        return future.result()
+
+    def load(self, level, channel=None) -> Future:
+        """
+        Returns the fields of a level in the background, e.g. for a level that is needed now but should not block the
+        calling thread. Only the latest load of a channel is kept: an earlier load of the same channel that did not
+        start yet is cancelled, so that scrubbing through the levels computes the level the slider stopped at rather
+        than every level it passed.
+
+        :param level: Index of the altitude level
+        :param channel: Hashable key of the caller, e.g. of a session, loads of other channels are never cancelled
+        :return: A Future of the fields, which is cancelled when a later load of the channel replaces it
+        """
+        with self._lock:
+            previous = self._loads.get(channel)
+            future = self._loads[channel] = self._loader.submit(self.get, level)
+        # cancelling runs the callbacks of the future right away, which must not happen while the lock is held
+        if previous is not None:
+            previous.cancel()
+        future.add_done_callback(partial(self._load_done, channel))
+        return future
+
+    def prefetch(self, levels):
+        """
+        Computes the given levels in the background. Prefetches of other levels that did not start yet are dropped, so
+        that scrubbing through the levels does not queue up work for levels that are no longer near the current one.
+
+        :param levels: Indices of the levels, in the order they should be computed
+        """
+        wanted = set(levels)
+        with self._lock:
+            for level, future in list(self._pending.items()):
+                if level not in wanted and future.cancel():
+                    del self._pending[level]
+            for level in levels:
+                if level not in self._levels and level not in self._pending:
+                    future = self._pending[level] = Future()
+                    self._executor.submit(self._prefetch, level, future)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self._loader.shutdown(wait=False)
+
+    def _load_done(self, channel, future):
+        with self._lock:
+            if self._loads.get(channel) is future:
+                del self._loads[channel]
+
+    def _prefetch(self, level, future):
+        with self._lock:
+            # the level was dropped from the prefetches or taken over by get in the meantime
+            if future.done() or future.running():
+                return
+            future.set_running_or_notify_cancel()
+        self._run(level, future)
+
+    def _run(self, level, future):
+        try:
+            fields = self.compute(level)
+        except BaseException as exc:
+            with self._lock:
+                del self._pending[level]
+            future.set_exception(exc)
+            return
+
+        with self._lock:
+            del self._pending[level]
+            self._levels[level] = fields
+            while len(self._levels) > self.max_levels:
+                self._levels.popitem(last=False)
+        future.set_result(fields)
+
+
+# Caches that are shared by all users in the process, see shared_cache
+_shared_caches = {}
+_shared_lock = threading.Lock()
+
+
+def shared_cache(key, compute, **kwargs) -> LevelCache:
+    """
+    Returns the LevelCache of a key, which is created on the first call and then shared for the lifetime of the process.
+    Under bokeh serve the app script runs once per session, and a cache per session would compute the same levels
+    again and multiply the memory bound by the number of sessions.
+
+    :param key: Hashable key of the cache, it has to change whenever compute would give other fields
+    :param compute: Function that takes a level index and returns its derived fields, only the one of the first call is
+        used
+    :param kwargs: Further arguments of LevelCache for the first call
+    :return: The shared LevelCache
+    """
+    with _shared_lock:
+        if key not in _shared_caches:
+            _shared_caches[key] = LevelCache(compute, **kwargs)
+        return _shared_caches[key]
@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class StreamingStats:
+    """
+    Statistics of values that arrive in chunks, computed in a single pass with bounded memory: the count, mean, minimum
+    and maximum are exact, the percentiles are estimated from a uniform random sample of the values. With the default
+    sample size the rank of an estimated percentile is off by less than about 0.5% of the values.
+
+    :param sample_size: Number of values kept for the percentiles, 0 disables them
+    :param seed: Seed of the sample, so that the estimates are reproducible
+    """
+
+    def __init__(self, sample_size=65536, seed=0):
+        self.sample_size = sample_size
+        self.count = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.default_rng(seed)
+        self._sample = np.empty(0, dtype=np.float32)
+        self._keys = np.empty(0)
+
+    def update(self, values):
+        """
+        Adds a chunk of values.
+
+        :param values: An array of valid values, of any shape
+        """
+        values = np.ravel(values)
+        if not values.size:
+            return
+        self.count += values.size
+        self.total += values.sum(dtype=np.float64)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        if self.sample_size:
+            # Every value gets a random key and the sample keeps the values with the smallest keys, which is a uniform
+            # sample of all values seen so far no matter how they are split into chunks
+            keys = np.concatenate((self._keys, self._rng.random(values.size)))
+            sample = np.concatenate((self._sample, values.astype(np.float32)))
+            if keys.size > self.sample_size:
+                keep = np.argpartition(keys, self.sample_size)[:self.sample_size]
+                keys, sample = keys[keep], sample[keep]
+            self._keys, self._sample = keys, sample
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentiles(self, q) -> np.ndarray:
+        """
+        Estimates percentiles of the values.
+
+        :param q: A sequence of percentiles in [0, 100]
+        :return: An array of the estimated values, the mean for percentiles of an empty stream
+        """
+        if not self._sample.size:
+            return np.full(len(q), self.mean)
+        return np.percentile(self._sample, q).astype(np.float64)
+
+    def result(self, q=()) -> dict:
+        """
+        :param q: A sequence of percentiles in [0, 100] to estimate
+        :return: A dict with the count, mean, min, max, the percentiles q and their estimated values. Without any
+            values the mean is 0 and the minimum and maximum are the mean.
+        """
+        empty = self.count == 0
+        return dict(count=self.count, mean=self.mean, min=self.mean if empty else self.min,
+                    max=self.mean if empty else self.max, percentiles=np.asarray(q, dtype=np.float64),
+                    percentile_values=self.percentiles(q) if len(q) else np.empty(0))
@@ -0,0 +1,128 @@
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import numpy as np
+
+from wind_volume import WindVolume
+
+# Central differences need one neighbouring row on each side, the rows of a tile are read with this many extra rows
+HALO = 1
+
+
+def divergence_vorticity(vx, vy) -> tuple:
+    """
+    Divergence and z-component of the vorticity of a 2D vector field. The gradient of each component is computed once
+    and shared by both fields. Axis 0 of the gradient is the derivative along the rows and axis 1 along the columns.
+
+    :param vx: A 2D array of the x components
+    :param vy: A 2D array of the y components
+    :return: A (divergence, vorticity) tuple of arrays of the same shape
+    """
+    dvx_0, dvx_1 = np.gradient(vx)
+    dvy_0, dvy_1 = np.gradient(vy)
+    return dvx_0 + dvy_1, dvy_0 - dvx_1
+
+
+def row_tiles(n_rows, tile_rows):
+    # (start, stop) of the tiles that cover the rows of a level
+    return [(start, min(start + tile_rows, n_rows)) for start in range(0, n_rows, tile_rows)]
+
+
+def _compute_tile(x_volume, y_volume, divergence, vorticity, level, start, stop):
+    # The tile is read together with its halo rows, so that its border rows get the same central differences as in the
+    # whole level, and the halo is cut off again. The rows of the level borders have no halo and keep the one-sided
+    # differences of np.gradient.
+    read_start, read_stop = max(start - HALO, 0), min(stop + HALO, x_volume.shape[0])
+    rows = slice(read_start, read_stop)
+    div, vort = divergence_vorticity(x_volume.level(level, rows), y_volume.level(level, rows))
+    inner = slice(start - read_start, stop - read_start)
+    divergence[level, start:stop] = div[inner]
+    vorticity[level, start:stop] = vort[inner]
+
+
+def compute_derived_volumes(x_volume, y_volume, divergence_path, vorticity_path, tile_rows=256, workers=None,
+                            progress=None) -> tuple:
+    """
+    Computes the divergence and vorticity of every level of two wind volumes and writes them to .npy files, which are
+    filled through memory maps. The levels are processed in tiles of rows on a thread pool, so that the memory used
+    depends on the tile size and the number of workers but not on the size of the volume.
+
+    :param x_volume: WindVolume of the x components
+    :param y_volume: WindVolume of the y components of the same shape
+    :param divergence_path: Path of the .npy file of the divergence
+    :param vorticity_path: Path of the .npy file of the vorticity
+    :param tile_rows: Number of rows of a tile, without the halo rows
+    :param workers: Number of threads, None uses one per CPU core
+    :param progress: Optional function that is called with the number of finished and of all tiles
+    :return: Read-only memory maps of the divergence and vorticity, levels x rows x columns float32 arrays in the
+        orientation of the plots
+    """
+    if x_volume.shape != y_volume.shape:
+        raise ValueError('the wind volumes have different shapes: {} and {}'.format(x_volume.shape, y_volume.shape))
+    if tile_rows < 1:
+        raise ValueError('tile_rows must be at least 1')
+
+    # the tiles replace the missing values with the means of the volumes, which are computed here once rather than by
+    # the first tiles of all threads
+    x_volume.load_stats()
+    y_volume.load_stats()
+
+    n_rows, n_columns, n_levels = x_volume.shape
+    # every level of the output is one contiguous block of the file
+    shape = (n_levels, n_rows, n_columns)
+    outputs = [np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+               for path in (divergence_path, vorticity_path)]
+
+    tiles = row_tiles(n_rows, tile_rows)
+    n_tiles = n_levels * len(tiles)
+    workers = workers or os.cpu_count()
+    futures = deque()
+
+    def finish_tile():
+        # raises the first error of a tile
+        futures.popleft().result()
+        if progress is not None:
+            progress(n_tiles - len(futures) - remaining, n_tiles)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # At most two tiles per worker are queued, so that the pending work does not grow with the volume
+        remaining = n_tiles
+        for level in range(n_levels):
+            for start, stop in tiles:
+                futures.append(executor.submit(_compute_tile, x_volume, y_volume, *outputs, level, start, stop))
+                remaining -= 1
+                if len(futures) > 2 * workers:
+                    finish_tile()
+        while futures:
+            finish_tile()
+
+    for output in outputs:
+        output.flush()
+    del outputs
+    return tuple(np.load(path, mmap_mode='r') for path in (divergence_path, vorticity_path))
+
+
+if __name__ == '__main__':
+    # python wind_derivatives.py Uf24.bin Vf24.bin
+    # python wind_derivatives.py Uf24.bin Vf24.bin --shape 500 500 100 --tile-rows 128 --workers 4
+    parser = argparse.ArgumentParser(description='Computes the divergence and vorticity of all levels of the wind '
+                                                 'volumes')
+    parser.add_argument('x_path', help='volume of the x components')
+    parser.add_argument('y_path', help='volume of the y components')
+    parser.add_argument('--shape', type=int, nargs=3, default=None, help='rows, columns and levels of the volumes')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--tile-rows', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    volume_args = {} if args.shape is None else dict(shape=args.shape)
+    x_wind, y_wind = WindVolume(args.x_path, **volume_args), WindVolume(args.y_path, **volume_args)
+
+    start = time.perf_counter()
+    compute_derived_volumes(x_wind, y_wind, os.path.join(args.output_dir, 'divergence.npy'),
+                            os.path.join(args.output_dir, 'vorticity.npy'), args.tile_rows, args.workers,
+                            progress=lambda done, total: print('\r{}/{} tiles'.format(done, total), end=''))
+    print('\nwritten to {} in {:.1f}s'.format(os.path.abspath(args.output_dir), time.perf_counter() - start))
@@ -0,0 +1,156 @@
+import os
+import threading
+
+import numpy as np
+
+# Normalizations of the vector magnitude to the HSV value: 'level' maps the range of the level itself to [0, 1] and
+# 'global' the range of the whole volume, so that the brightness is comparable between levels
+NORMALIZATIONS = ('level', 'global')
+
+
+def vector_hue(vx, vy) -> np.ndarray:
+    """
+    Hue of the vectors, the angle to the positive x-axis as a fraction of a full turn.
+
+    :param vx: x components of the vectors
+    :param vy: y components of the vectors
+    :return: An array of hues in [0, 1)
+    """
+    hue = np.arctan2(vy, vx) / (2 * np.pi)
+    hue[hue < 0] += 1
+    # angles that round to a full turn in float32 are the same as 0
+    hue[hue >= 1] = 0
+    return hue
+
+
+def vector_magnitude(vx, vy) -> np.ndarray:
+    return np.hypot(vx, vy)
+
+
+def normalized_value(magnitude, value_range=None) -> np.ndarray:
+    """
+    Maps vector magnitudes to HSV values.
+
+    :param magnitude: An array of vector magnitudes
+    :param value_range: The (low, high) magnitudes that are mapped to 0 and 1, if None the range of the array is used
+    :return: An array of values in [0, 1]
+    """
+    low, high = value_range if value_range is not None else (np.amin(magnitude), np.amax(magnitude))
+    if high <= low:
+        return np.zeros_like(magnitude)
+    return np.clip((magnitude - low) / (high - low), 0, 1)
+
+
+def hsv_to_rgba(hue, value, saturation=1.0, out=None) -> np.ndarray:
+    """
+    Vectorized colorsys.hsv_to_rgb for whole images, writing 8 bit RGBA colors. Like 255 * hsv_to_rgb(...) stored in a
+    uint8 array, the channels are truncated rather than rounded.
+
+    :param hue: An array of hues in [0, 1)
+    :param value: An array of values in [0, 1] of the same shape
+    :param saturation: The saturation, a scalar or an array in [0, 1]
+    :param out: A preallocated uint8 array of shape hue.shape + (4,), if None a new one is created
+    :return: The uint8 RGBA array
+    """
+    if out is None:
+        out = np.empty(np.shape(hue) + (4,), dtype=np.uint8)
+
+    # Branch free form of colorsys.hsv_to_rgb: with h6 = 6 * hue, the share of the value that each channel gets at full
+    # saturation is clip(|h6 - 3| - 1, 0, 1) for red, clip(2 - |h6 - 2|, 0, 1) for green and clip(2 - |h6 - 4|, 0, 1)
+    # for blue, and a lower saturation mixes in the value evenly
+    shape = (3,) + (1,) * np.ndim(hue)
+    share = np.subtract(np.multiply(hue, 6.0, dtype=np.float32), np.array([3, 2, 4], dtype=np.float32).reshape(shape))
+    np.abs(share, out=share)
+    share *= np.array([1, -1, -1], dtype=np.float32).reshape(shape)
+    share += np.array([-1, 2, 2], dtype=np.float32).reshape(shape)
+    np.clip(share, 0, 1, out=share)
+    share *= np.multiply(value, 255.0 * saturation, dtype=np.float32)
+    share += np.multiply(value, 255.0 * (1.0 - saturation), dtype=np.float32)
+    out[..., :3] = np.moveaxis(share, 0, -1)
+    out[..., 3] = 255
+    return out
+
+
+class HsvLut:
+    """
+    Precomputed hue x value table of RGBA colors with full saturation, for converting many frames. The table is fine
+    enough that the colors are within one step of hsv_to_rgba.
+
+    :param n_hue: Number of hue steps
+    :param n_value: Number of value steps
+    """
+
+    def __init__(self, n_hue=1536, n_value=512):
+        self.n_hue = n_hue
+        self.n_value = n_value
+        hue, value = np.meshgrid(np.arange(n_hue) / n_hue, np.arange(n_value) / (n_value - 1), indexing='ij')
+        self.table = hsv_to_rgba(hue, value)
+
+    def __call__(self, hue, value, out=None) -> np.ndarray:
+        """
+        Looks up the RGBA colors of the nearest table entries.
+
+        :param hue: An array of hues in [0, 1)
+        :param value: An array of values in [0, 1] of the same shape
+        :param out: A preallocated uint8 array of shape hue.shape + (4,), if None a new one is created
+        :return: The uint8 RGBA array
+        """
+        hue_idx = np.rint(np.asarray(hue) * self.n_hue).astype(np.intp)
+        hue_idx %= self.n_hue
+        value_idx = np.rint(np.asarray(value) * (self.n_value - 1)).astype(np.intp)
+        return np.take(self.table.reshape(-1, 4), hue_idx * self.n_value + value_idx, axis=0, out=out)
+
+
+def vector_color_coding(vx, vy, value_range=None, lut=None, out=None) -> np.ndarray:
+    """
+    Color codes a 2D vector field: the hue is the direction of a vector, the saturation 1 and the value its normalized
+    magnitude.
+
+    :param vx: A 2D array of the x components
+    :param vy: A 2D array of the y components
+    :param value_range: The (low, high) magnitudes that are mapped to the darkest and brightest colors, if None the
+        range of this field is used
+    :param lut: An HsvLut to look the colors up in, if None they are computed exactly
+    :param out: A preallocated uint8 array of shape vx.shape + (4,), if None a new one is created
+    :return: The uint8 RGBA image
+    """
+    hue = vector_hue(vx, vy)
+    value = normalized_value(vector_magnitude(vx, vy), value_range)
+    if lut is not None:
+        return lut(hue, value, out=out)
+    return hsv_to_rgba(hue, value, out=out)
+
+
+def magnitude_range(x_volume, y_volume, cache_path=None) -> tuple:
+    """
+    Range of the vector magnitudes of all levels of two wind volumes, for the 'global' normalization. The levels are
+    read one at a time, and the range is then read from a sidecar file as long as neither data file changed.
+
+    :param x_volume: WindVolume of the x components
+    :param y_volume: WindVolume of the y components
+    :param cache_path: Path of the sidecar file, if None the path of the x volume with the extension .magnitude.npz
+    :return: A (low, high) tuple
+    """
+    cache_path = cache_path or os.path.splitext(x_volume.path)[0] + '.magnitude.npz'
+    source_stats = np.stack((x_volume.source_stat(), y_volume.source_stat()))
+    y_name = os.path.basename(y_volume.path)
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            if np.array_equal(cache['source_stats'], source_stats) and str(cache['y_name']) == y_name:
+                low, high = cache['magnitude_range']
+                return float(low), float(high)
+    except (OSError, KeyError, ValueError):
+        # a missing, outdated or unreadable sidecar file is simply rebuilt
+        pass
+
+    low, high = np.inf, -np.inf
+    for level in range(x_volume.n_levels):
+        magnitude = vector_magnitude(x_volume.level(level), y_volume.level(level))
+        low, high = min(low, float(magnitude.min())), max(high, float(magnitude.max()))
+
+    # written to a temporary file first, see WindVolume
+    tmp_path = '{}.{}.{}.tmp'.format(cache_path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as fh:
+        np.savez(fh, source_stats=source_stats, y_name=y_name, magnitude_range=np.array([low, high]))
+    os.replace(tmp_path, cache_path)
+    return low, high
@@ -0,0 +1,145 @@
+import os
+import threading
+
+import numpy as np
+
+from streaming_stats import StreamingStats
+
+# Shape of the Uf24/Vf24 volumes (rows, columns, altitude levels) and the value of the missing data points
+VOLUME_SHAPE = (500, 500, 100)
+NODATA = 1e35
+# Percentiles that are estimated along with the statistics of a volume, e.g. for color ranges that ignore outliers
+PERCENTILES = (1, 5, 50, 95, 99)
+
+
+class WindVolume:
+    """
+    Lazily sliced view on a raw wind volume, a file of big-endian float32 values in Fortran order. The file is memory
+    mapped and only the levels that are requested are read: the byte order conversion, the vertical flip and the
+    replacement of the missing values with the mean of all valid values are applied to the requested level only.
+
+    :param path: Path of the .bin file
+    :param shape: (rows, columns, levels) of the volume
+    :param nodata: Value of the missing data points
+    :param stats_path: Path of the sidecar file that caches the statistics of the volume, if None the path of the data
+        file with the extension .stats.npz is used
+    :param percentiles: Percentiles of the valid values that are estimated along with the other statistics
+    """
+
+    def __init__(self, path, shape=VOLUME_SHAPE, nodata=NODATA, stats_path=None, percentiles=PERCENTILES):
+        self.path = path
+        self.shape = tuple(shape)
+        self.nodata = np.float32(nodata)
+        self.stats_path = stats_path or os.path.splitext(path)[0] + '.stats.npz'
+        self.percentiles = np.asarray(percentiles, dtype=np.float64)
+        # every level of a Fortran ordered volume is one contiguous block of the file
+        self.data = np.memmap(path, dtype='>f4', mode='r', shape=self.shape, order='F')
+        self._stats = None
+        self._stats_lock = threading.Lock()
+
+    @property
+    def n_levels(self) -> int:
+        return self.shape[2]
+
+    @property
+    def stats(self) -> dict:
+        """
+        Number, mean, minimum, maximum and estimated percentiles of the valid values of the whole volume, computed in
+        a single pass over the file and then read from the sidecar file as long as the data file did not change. The
+        percentiles are a dict from the percentile to its value.
+        """
+        return self.load_stats()
+
+    def load_stats(self) -> dict:
+        """
+        Reads or computes the statistics of the volume if that did not happen yet, e.g. before several threads start to
+        read levels.
+
+        :return: The statistics, see stats
+        """
+        # levels are read from several threads, which must not all compute the statistics at once
+        with self._stats_lock:
+            if self._stats is None:
+                self._stats = self._load_stats()
+        return self._stats
+
+    def value_range(self, percentiles=None) -> tuple:
+        """
+        Range of the valid values, e.g. for a color mapper.
+
+        :param percentiles: A (low, high) pair of the percentiles of the volume that bound the range, if None the
+            minimum and maximum are used
+        :return: A (low, high) tuple
+        """
+        if percentiles is None:
+            return self.stats['min'], self.stats['max']
+        return tuple(self.stats['percentiles'][q] for q in percentiles)
+
+    def raw_level(self, level, rows=slice(None)) -> np.ndarray:
+        """
+        Reads one level without replacing the missing values.
+
+        :param level: Index of the altitude level
+        :param rows: A slice of the rows to read, counted in the flipped orientation of the plots
+        :return: A rows x columns float32 array in native byte order, flipped like the plots expect it
+        """
+        n_rows = self.shape[0]
+        start, stop, _ = rows.indices(n_rows)
+        return np.flipud(self.data[n_rows - stop:n_rows - start, :, level]).astype(np.float32)
+
+    def level(self, level, rows=slice(None)) -> np.ndarray:
+        """
+        Reads one level and replaces its missing values with the mean of all valid values of the volume.
+
+        :param level: Index of the altitude level
+        :param rows: A slice of the rows to read, counted in the flipped orientation of the plots
+        :return: A rows x columns float32 array in native byte order, flipped like the plots expect it
+        """
+        values = self.raw_level(level, rows)
+        values[values == self.nodata] = self.stats['mean']
+        return values
+
+    def source_stat(self) -> np.ndarray:
+        """
+        :return: The modification time in ns and the size of the data file, sidecar files of the volume are only valid
+            for the same ones
+        """
+        stat = os.stat(self.path)
+        return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+    def _load_stats(self) -> dict:
+        source_stat = self.source_stat()
+        try:
+            with np.load(self.stats_path, allow_pickle=False) as cache:
+                if (np.array_equal(cache['source_stat'], source_stat)
+                        and np.array_equal(cache['percentiles'], self.percentiles)):
+                    return self._stats_dict({key: cache[key] for key in cache.files if key != 'source_stat'})
+        except (OSError, KeyError, ValueError):
+            # a missing, outdated or unreadable sidecar file is simply rebuilt
+            pass
+
+        stats = self._compute_stats()
+
+        # writing to a temporary file first so that concurrent processes never read a partially written sidecar file,
+        # the thread id keeps volumes of the same file in different threads apart
+        tmp_path = '{}.{}.{}.tmp'.format(self.stats_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as fh:
+            np.savez(fh, source_stat=source_stat, **stats)
+        os.replace(tmp_path, self.stats_path)
+        return self._stats_dict(stats)
+
+    def _compute_stats(self) -> dict:
+        # One level at a time, so that only a single level is held in memory. The minimum and maximum are the ones of
+        # the volume after the replacement, which are the ones of the valid values since their mean lies between them.
+        stats = StreamingStats()
+        for level in range(self.n_levels):
+            values = self.data[:, :, level].astype(np.float32)
+            stats.update(values[values < self.nodata])
+        return stats.result(self.percentiles)
+
+    @staticmethod
+    def _stats_dict(arrays) -> dict:
+        stats = {key: float(arrays[key]) for key in ('mean', 'min', 'max')}
+        stats['count'] = int(arrays['count'])
+        stats['percentiles'] = dict(zip(arrays['percentiles'].tolist(), arrays['percentile_values'].tolist()))
+        return stats